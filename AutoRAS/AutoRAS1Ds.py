@@ -8,20 +8,47 @@ Provides functions for automating input/output HEC-RAS 1D steady state models
 
 """
 
-import os, parserasgeo as prg, rascontrol
-import win32com.client
+import os, sys, parserasgeo as prg, rascontrol
+import re
+import csv
+import pickle
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import utils
+import backend
+from backend import session
 import logging
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
+import h5py
+import numpy as np
 import pandas as pd
 
 import qgis
 from qgis.core import *
 from PyQt5.QtCore import *
 
-RAS_version_string = "507"
+# HDF paths of the steady profiles and of the cross sections in the plan HDF file
+STEADY_PATH = "/Results/Steady/Output/Output Blocks/Base Output/Steady Profiles"
+STEADY_XS_PATH = "/Results/Steady/Output/Geometry Info/Cross Section Only"
 
+# files of HEC-RAS models (project, plan, geometry, flow and output files, terrain), 
+# e.g. for the file_filter of unzip_all
+RAS_FILE_PATTERN = re.compile(r"\.(prj|rasmap|[gpfuq]\d\d|[gpu]\d\d\.hdf|o\d\d|hdf|dss|tif|tiff|vrt)$", re.IGNORECASE)
 
-def RunRASprj(RAS_prj_file):
+# number of parsed geometry files kept in memory (see RASParseGeo)
+GEO_CACHE_SIZE = 8
+
+# parsed geometry files by (filepath, mtime, size), least recently used first
+_GEO_CACHE = OrderedDict()
+
+# columns of the catalog of HEC-RAS projects written by LocateRASprj
+CATALOG_COLUMNS = ["prj", "geo", "plan", "status", "mtime", "size"]
+
+
+def RunRASprj(RAS_prj_file, cache_dir=None, ras_backend=None):
     """
     Runs the current plan associated with HEC-RAS .prj file and returns associated plan and geometry file 
     if run does not throw an error
@@ -29,7 +56,10 @@ def RunRASprj(RAS_prj_file):
     Parameters
     ----------
     RAS_prj_file : string (filepath)
-        
+    cache_dir : string (folder of the run cache, optional)
+        if the plan, geometry and flow files are identical to a cached run, its plan HDF 
+        and binary output are restored instead of computing the plan again
+    ras_backend : solver backend (optional, default a warm HEC-RAS controller session)
 
     Returns
     -------
@@ -39,98 +69,231 @@ def RunRASprj(RAS_prj_file):
 
     """
     
-    hec = win32com.client.Dispatch("RAS" + RAS_version_string + ".HECRASController")
-    try:
-        logging.info("Loading RAS Project")         
-        hec.Project_Open(RAS_prj_file) 
-        logging.info("Computing Current Plan")   
-        hec.Compute_CurrentPlan(None,None,True)
-    except:  
-        logging.error("Current RAS plan failed to execute")
-        return("Error")
-    else:
-        run_status = hec.Compute_Complete()
+    with session(ras_backend) as ras:
+        if cache_dir:
+            plan_file = utils.current_plan_file(RAS_prj_file)
+            try:
+                key = utils.run_cache_key(plan_file, ras.version)
+            except (TypeError, OSError):
+                logging.warning("Cannot read the current plan of " + RAS_prj_file + ": run cache not used")
+                cache_dir = None
+            else:
+                outputs = _plan_outputs(plan_file)
+                if utils.run_cache_restore(cache_dir, key, {"plan.hdf": outputs["plan.hdf"]}):
+                    # the binary output is not written by every HEC-RAS version
+                    utils.run_cache_restore(cache_dir, key, {"output.O": outputs["output.O"]})
+                    logging.info("Restored current plan from run cache")
+                    geo_file = [f for f in utils.plan_input_files(plan_file) if os.path.splitext(f)[1][1:2].lower() == "g"][0]
+                    # absolute filepaths, as returned by the backend after a run
+                    return([RAS_prj_file, os.path.abspath(geo_file), os.path.abspath(plan_file)])
+
+        try:
+            logging.info("Loading RAS Project")         
+            ras.open(RAS_prj_file) 
+            logging.info("Computing Current Plan")   
+            run_status = ras.compute_current_plan()
+        except:  
+            logging.error("Current RAS plan failed to execute")
+            # launch a new session at the next call
+            ras.close()
+            return("Error")
         logging.info("Run_status: " + str(run_status))    
         if run_status:
-            return([RAS_prj_file, hec.CurrentGeomFile(), hec.CurrentPlanFile()])
+            if cache_dir:
+                utils.run_cache_store(cache_dir, key, outputs)
+            return([RAS_prj_file, ras.current_geom_file(), ras.current_plan_file()])
         else:
             logging.error("Error in running current plan") 
             return("Error")
-    finally: 
-        hec.QuitRas()
+
+def _plan_outputs(plan_file):
+    """
+    returns the output files of a plan (plan HDF and binary output), by their name in the run cache
+    """
+    base, ext = os.path.splitext(plan_file)
+    return {"plan.hdf": plan_file + ".hdf", "output.O": base + ".O" + ext[2:]}
         
-def LocateRASprj(input_folder,output_file):
+def FindRASprj(input_folder, archives=True):
     """
-    locates HEC-RAS prj files
+    discovers HEC-RAS prj files (prj files of GIS projections are skipped)
 
     Parameters
     ----------
     input_folder : filepath (string)
         folder where all unzipped files are located.
-    output_file: filepath (string) to output csv
-        file which stores list of prj, geo and plan files
+    archives : Boolean
+        also look inside the zip files (and the zip files inside them) without extracting them;
+        their prj files are given as archive paths, e.g. outer.zip!/inner.zip!/model.prj
 
     Returns
     -------
-    None
+    generator of the filepaths of the prj files
 
-    """        
-    RAS_file_df = pd.DataFrame(columns=["prj","geo","plan"])
+    """
     for root, dirs, files in os.walk(input_folder):
         for name in files:
-            if name.endswith(".prj"):
-                logging.info("Processing: " + root)
-                print("Processing: " + root)
-                result = RunRASprj(os.path.join(root, name))
-                if result != "Error":
-                    logging.info("Storing RAS project info")
-                    result_series = pd.Series(result, index = RAS_file_df.columns)
-                    RAS_file_df = RAS_file_df.append(result_series, ignore_index=True) 
-    RAS_file_df.to_csv(output_file)
-                    
-                    
-
-        
-def _unzip_files(input_folder,unzip_filelist):
+            if name.lower().endswith(".prj"):
+                prj_file = os.path.join(root, name)
+                try:
+                    with open(prj_file, "rb") as f:
+                        is_RAS = f.readline().startswith(b"Proj Title=")
+                except OSError:
+                    is_RAS = False
+                if is_RAS:
+                    yield prj_file
+            elif archives and name.lower().endswith(".zip"):
+                archive = os.path.join(root, name)
+                try:
+                    for member, zip_ref, info in utils.walk_archive(archive):
+                        if member.lower().endswith(".prj"):
+                            try:
+                                with zip_ref.open(info) as f:
+                                    is_RAS = f.readline().startswith(b"Proj Title=")
+                            except (BadZipFile, OSError):
+                                logging.error("Cannot read archive member: " + member)
+                                is_RAS = False
+                            if is_RAS:
+                                yield member
+                except (BadZipFile, OSError):
+                    logging.error("Cannot read archive: " + archive)
+
+def LocateRASprj(input_folder,output_file,processes=None,cache_dir=None,ras_backend=None):
     """
+    locates HEC-RAS prj files, runs their current plan in parallel and records them in a 
+    csv catalog, one row written as soon as each run completes 
+    
+    Projects already in the catalog whose prj file is unchanged (same mtime and size) 
+    are skipped, so that an interrupted or repeated call only runs the new projects.
+    Projects inside zip files (see FindRASprj) cannot be run by HEC-RAS: their current plan 
+    and geometry are read from the project and plan files, and recorded as "Archived".
+
     Parameters
     ----------
-    folder_name : filepath (string)
-        folder containing the zipped HEC-RAS files
-    unzip_filelist : list
-        list of zipped files processed
+    input_folder : filepath (string)
+        folder where all unzipped files are located.
+    output_file: filepath (string) to output csv
+        file which stores list of prj, geo and plan files, the status of the run 
+        ("Done", "Error" or "Archived") and the mtime (ns) and size of the prj file 
+        (or of the zip file holding it)
+    processes : Integer (optional)
+        number of projects run at the same time (default number of CPUs)
+    cache_dir : filepath (string) (optional)
+        folder of the run cache (see RunRASprj)
+    ras_backend : solver backend (optional, default a warm HEC-RAS controller session), 
+        e.g. backend.CommandBackend or backend.FakeBackend; each process uses its own copy of it
 
     Returns
     -------
-    ctr : Integer
-        Number of zip files processed in current run
-    unzip_file_list : List
-        list of all zipped files processed 
+    None
 
-    """
+    """        
+    catalog = _ReadCatalog(output_file)
+    if os.path.exists(output_file):
+        # rewrite the catalog in the current format, without the rows cut by an interrupted run
+        _WriteCatalog(output_file, catalog)
+    # projects which failed are run again
+    recorded = {prj: (mtime, size) for prj, status, mtime, size in 
+                zip(catalog["prj"], catalog["status"], catalog["mtime"], catalog["size"])
+                if status != "Error"}
     
-    ctr = 0
-    for root, dirs, files in os.walk(input_folder):
-        for name in files:
-            cur_file = os.path.join(root, name)
-            if name.endswith(".zip") and cur_file not in unzip_filelist:
-                try:
-                    with ZipFile(cur_file, 'r') as zip_ref:
-                        zip_ref.extractall(root + "//" + name[:-4])
-                        ctr = ctr+1
-                        unzip_filelist.append(cur_file)
-                except:  
-                    logging.error("Cannot unzip: " + cur_file)
-    return ctr, unzip_filelist
+    with open(output_file, "a", newline="") as f_out, \
+         ProcessPoolExecutor(processes) as pool:
+        writer = csv.writer(f_out)
+        if f_out.tell() == 0:
+            writer.writerow(CATALOG_COLUMNS)
+        
+        runs = {}
+        for prj_file in FindRASprj(input_folder):
+            st = utils.path_stat(prj_file)
+            stamp = (str(st.st_mtime_ns), str(st.st_size))
+            if recorded.get(prj_file) == stamp:
+                continue
+            logging.info("Processing: " + os.path.dirname(prj_file))
+            if utils.is_archive_path(prj_file):
+                runs[pool.submit(_CatalogRASprj, prj_file)] = (prj_file, stamp)
+            else:
+                runs[pool.submit(RunRASprj, prj_file, cache_dir, ras_backend)] = (prj_file, stamp)
+        
+        for run in as_completed(runs):
+            prj_file, stamp = runs[run]
+            try:
+                result = run.result()
+            except Exception:
+                logging.exception("Current RAS plan of " + prj_file + " failed to execute")
+                result = "Error"
+            if result != "Error":
+                logging.info("Storing RAS project info")
+                row = [prj_file, result[1], result[2], "Archived" if utils.is_archive_path(prj_file) else "Done"]
+            else:
+                row = [prj_file, "", "", "Error"]
+            # make each row durable before the next one
+            writer.writerow(row + list(stamp))
+            f_out.flush()
+            os.fsync(f_out.fileno())
+    
+    # keep the latest row of each project
+    _WriteCatalog(output_file, _ReadCatalog(output_file))
 
-def unzip_all(folder_name):
+def _CatalogRASprj(RAS_prj_file):
+    """
+    returns the prj, geometry and current plan files of a project without running it, 
+    read from the project and plan files (e.g. of a project inside a zip file)
+    """
+    plan_file = utils.current_plan_file(RAS_prj_file)
+    geo_file = [f for f in utils.plan_input_files(plan_file) if os.path.splitext(f)[1][1:2].lower() == "g"][0]
+    return [RAS_prj_file, geo_file, plan_file]
+
+def _ReadCatalog(output_file):
+    """
+    reads the catalog of LocateRASprj (latest row of each project), empty if it does not exist
+    """
+    rows = []
+    if os.path.exists(output_file):
+        with open(output_file, "r", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, CATALOG_COLUMNS)
+            if header == CATALOG_COLUMNS:
+                # rows of a run interrupted while writing are incomplete (fields or size 
+                # missing), they are run again
+                rows = [dict(zip(CATALOG_COLUMNS, row)) for row in reader 
+                        if len(row) == len(CATALOG_COLUMNS) and bool(row[-2]) == bool(row[-1])]
+            else:
+                # catalog of an earlier version (",prj,geo,plan"), which only lists the 
+                # projects run without error; without mtime and size they are run again
+                rows = [dict(zip(header, row), status="Done") for row in reader if len(row) == len(header)]
+    catalog = pd.DataFrame(rows, columns=CATALOG_COLUMNS).fillna("")
+    return catalog.drop_duplicates("prj", keep="last").reset_index(drop=True)
+
+def _WriteCatalog(output_file, catalog):
+    """
+    replaces the catalog of LocateRASprj in one step, so that it is never left half written
+    """
+    fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(output_file)))
+    with os.fdopen(fd, "w", newline="") as f_tmp:
+        catalog.to_csv(f_tmp, index=False)
+    # keep the permissions of the catalog (mkstemp creates the file readable by its owner only)
+    shutil.copymode(output_file, tmp_file)
+    os.replace(tmp_file, output_file)
+                    
+
+        
+def unzip_all(folder_name, file_filter=None, threads=None):
     """
     Unzips all .zip folders in a given folder, including those inside zipped folders    
+    
+    Each zip file is extracted next to itself (folder.zip to folder/). Zip files inside 
+    zip files are opened from memory as soon as they are found, instead of being written 
+    to disk and found by scanning the folder again; the members of a zip file are 
+    decompressed on a thread pool.
 
     Parameters
     ----------
     folder_name : filepath (string)
         folder containing the zipped HEC-RAS files
+    file_filter : regular expression (string or compiled) (optional)
+        only the files matching it are extracted, e.g. RAS_FILE_PATTERN (default all files)
+    threads : Integer (optional)
+        number of threads decompressing the files (default ThreadPoolExecutor default)
 
     Returns
     -------
@@ -138,16 +301,85 @@ def unzip_all(folder_name):
 
     """
     logging.info("Begin Unzipping")   
-    unzip_list = []   
+    if isinstance(file_filter, str):
+        file_filter = re.compile(file_filter, re.IGNORECASE)
+    
+    # zip files of the folder, with their destination folder and name for the log
+    archives = []
+    for root, dirs, files in os.walk(folder_name):
+        for name in files:
+            if name.lower().endswith(".zip"):
+                cur_file = os.path.join(root, name)
+                archives.append((cur_file, os.path.join(root, name[:-4]), cur_file))
+    
     total_zip_file_ctr = 0
-    zip_file_ctr, unzip_list = _unzip_files(folder_name, unzip_list)
-    total_zip_file_ctr = total_zip_file_ctr + zip_file_ctr
-    while zip_file_ctr > 0:
-        logging.info("New files unzipped: " + str(zip_file_ctr))  
-        zip_file_ctr, unzip_list = _unzip_files(folder_name,unzip_list)
+    with ThreadPoolExecutor(threads) as pool:
+        for archive in archives:
+            # stack of the open zip files (zip file or file object, destination folder, name
+            # for the log, open ZipFile, members left, extraction futures): an inner zip file
+            # is extracted as soon as it is found (depth first), so that only one inner zip
+            # file per nesting level is held at a time
+            stack = []
+            work = [archive]
+            while work or stack:
+                if work:
+                    source, dest, label = work.pop()
+                    try:
+                        zip_ref = ZipFile(source, "r")
+                    except (BadZipFile, OSError):
+                        logging.error("Cannot unzip: " + label)
+                        if not isinstance(source, str):
+                            source.close()
+                        continue
+                    stack.append((source, dest, label, zip_ref, iter(zip_ref.infolist()), []))
+                    continue
+                
+                source, dest, label, zip_ref, members, extracted = stack[-1]
+                for info in members:
+                    if info.is_dir():
+                        continue
+                    if info.filename.lower().endswith(".zip"):
+                        # extract the inner zip file next, from memory (or a temporary file if large)
+                        inner = tempfile.SpooledTemporaryFile(max_size=utils.INNER_ZIP_MEMORY)
+                        with zip_ref.open(info) as member:
+                            shutil.copyfileobj(member, inner)
+                        inner.seek(0)
+                        work.append((inner, _member_path(dest, info.filename[:-4]), label + "!/" + info.filename))
+                        break
+                    elif file_filter is None or file_filter.search(info.filename):
+                        extracted.append(pool.submit(_extract_member, zip_ref, info, dest))
+                else:
+                    # all the members are submitted, close the zip file once they are extracted
+                    stack.pop()
+                    errors = [e for e in extracted if e.exception() is not None]
+                    zip_ref.close()
+                    if not isinstance(source, str):
+                        source.close()
+                    if errors:
+                        logging.error("Cannot unzip: " + label + " (" + str(errors[0].exception()) + ")")
+                    else:
+                        total_zip_file_ctr = total_zip_file_ctr + 1
         
     logging.info("Unzipping Finished")   
     logging.info("Total files unzipped: " + str(total_zip_file_ctr))
+
+def _member_path(dest, filename):
+    """
+    filepath of a zip member in the destination folder (absolute paths and ".." are removed)
+    """
+    parts = [p for p in filename.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    if parts and parts[0].endswith(":"):
+        parts = parts[1:]
+    return os.path.join(dest, *parts)
+
+def _extract_member(zip_ref, info, dest):
+    """
+    decompresses a zip member to the destination folder
+    """
+    target = _member_path(dest, info.filename)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with zip_ref.open(info) as member, open(target, "wb") as f:
+        shutil.copyfileobj(member, f)
     
     
 def RASGeo2gdf(RAS_geo_file):
@@ -166,13 +398,88 @@ def RASGeo2gdf(RAS_geo_file):
     """   
     pass
 
+def RASParseGeo(RAS_geo_file, cache_dir=None):
+    """
+    parses a HEC-RAS geometry file with parserasgeo once: the parsed geometry is kept in memory 
+    (the GEO_CACHE_SIZE most recently used files) and, if cache_dir is given, pickled to disk, 
+    both keyed by the filepath, mtime and size of the file
+
+    Parameters
+    ----------
+    RAS_geo_file : file path to RAS geometry file 
+        (or archive path of a geometry file inside zip files, e.g. outer.zip!/inner.zip!/model.g01)
+        an already parsed geometry is returned as is
+    cache_dir : filepath (string) (optional)
+        folder of the pickled parsed geometries
+
+    Returns
+    -------
+    parsed geometry (prg.ParseRASGeo)
+    
+    """
+    if not isinstance(RAS_geo_file, (str, os.PathLike)):
+        return RAS_geo_file
+    st = utils.path_stat(RAS_geo_file)
+    key = (os.path.abspath(RAS_geo_file), st.st_mtime_ns, st.st_size)
+    if key in _GEO_CACHE:
+        _GEO_CACHE.move_to_end(key)
+        return _GEO_CACHE[key]
+    
+    RAS_geo_obj = None
+    if cache_dir:
+        pickle_file = os.path.join(cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + ".pkl")
+        if os.path.exists(pickle_file):
+            try:
+                with open(pickle_file, "rb") as f:
+                    RAS_geo_obj = pickle.load(f)
+            except Exception:
+                # e.g. truncated, or pickled with another version of parserasgeo: parse it again
+                logging.warning("Cannot read cached parsed geometry of " + str(RAS_geo_file))
+                RAS_geo_obj = None
+                try:
+                    os.remove(pickle_file)
+                except OSError:
+                    pass
+    if RAS_geo_obj is None:
+        with utils.local_file(RAS_geo_file) as geo_file:
+            RAS_geo_obj = prg.ParseRASGeo(geo_file)
+        # the parsed file is a temporary copy for the members of zip files, keep the filepath
+        RAS_geo_obj.source_file = str(RAS_geo_file)
+        if cache_dir:
+            # written to a temporary file first so that a pickle is never read while incomplete
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(RAS_geo_obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, pickle_file)
+            except Exception:
+                logging.warning("Cannot cache parsed geometry of " + str(RAS_geo_file))
+                os.remove(tmp_file)
+    
+    _GEO_CACHE[key] = RAS_geo_obj
+    while len(_GEO_CACHE) > GEO_CACHE_SIZE:
+        _GEO_CACHE.popitem(last=False)
+    return RAS_geo_obj
+
+def _geo_name(RAS_geo_file):
+    """
+    name of a geometry file (without extension) for the output files, from its filepath or parsed geometry
+    """
+    if not isinstance(RAS_geo_file, (str, os.PathLike)):
+        # filepath given to RASParseGeo (geo_filename is a temporary copy for the members of zip files)
+        RAS_geo_file = getattr(RAS_geo_file, "source_file", None) or getattr(RAS_geo_file, "geo_filename", "geometry")
+    return os.path.basename(RAS_geo_file).split(".")[0]
+
 def RASExtractCRS(RAS_geo_file):
     """
     returns the EPSG code of geo file if it exists else return None
     
     Parameters
     ----------
-    RAS_geo_file : file path to RAS geometry file
+    RAS_geo_file : file path to RAS geometry file 
+        (or archive path of a geometry file inside zip files, e.g. outer.zip!/inner.zip!/model.g01,
+        or parsed geometry, see RASParseGeo)
 
     Returns
     -------
@@ -180,7 +487,7 @@ def RASExtractCRS(RAS_geo_file):
     
     """
     try:
-        RAS_geo_obj = prg.ParseRASGeo(RAS_geo_file)
+        RAS_geo_obj = RASParseGeo(RAS_geo_file)
         epsg_code = [item.strip().split('=')[1] for item in RAS_geo_obj.geo_list if type(item)== str if "GIS Projection Zone" in item][0]
         return epsg_code
     except:
@@ -195,7 +502,9 @@ def RASGeo2Shp(RAS_geo_file, output_folder):
     Parameters
     ----------
     RAS_geo_file : TYPE
-        DESCRIPTION.
+        DESCRIPTION. 
+        (or archive path of a geometry file inside zip files, e.g. outer.zip!/inner.zip!/model.g01,
+        or parsed geometry, see RASParseGeo)
     output_folder : TYPE
         DESCRIPTION.
 
@@ -206,7 +515,7 @@ def RASGeo2Shp(RAS_geo_file, output_folder):
 
     """
     try:
-        g_filename = os.path.basename(RAS_geo_file).split(".")[0]
+        g_filename = _geo_name(RAS_geo_file)
         out_file_Xs = os.path.join(output_folder,g_filename + "_XS.shp")
         out_file_CL = os.path.join(output_folder,g_filename + "_CL.shp")
         ctr=1
@@ -222,9 +531,9 @@ def RASGeo2Shp(RAS_geo_file, output_folder):
             
         
         # LOAD RAS GEOMTERY AND GET CRS
-        RAS_geo_obj = prg.ParseRASGeo(RAS_geo_file)
+        RAS_geo_obj = RASParseGeo(RAS_geo_file)
         logging.info("Extracting projection system")
-        epsg_code = RASExtractCRS(RAS_geo_file)
+        epsg_code = RASExtractCRS(RAS_geo_obj)
         
         # CREATE SHAPEFILES
         
@@ -241,77 +550,89 @@ def RASGeo2Shp(RAS_geo_file, output_folder):
             
         # LOAD XS in CREATED SHAPEFILE
         
+        Xs_feats = []
         for Xs in RAS_geo_obj.get_cross_sections():
             logging.info("Processing cross-section: " + str(Xs.header.station.value) + " River: " + Xs.river + " Reach: " + Xs.reach)
-            # make polyline from cutline
-            cutline_feat = QgsFeature()
-            cutline_x = [float(x[0]) for x in Xs.cutline.points]
-            cutline_y = [float(x[1]) for x in Xs.cutline.points]
-            cutline_point_list = [QgsPoint(cutline_x[i],cutline_y[i]) for i in range(len(cutline_x))]
-            cutline_feat.setGeometry(QgsGeometry.fromPolyline(cutline_point_list))
-            
-            # Add 3D points to cutline
-            Xs_pt_list = []
-            #get first pt separately
-            Xs_pt = QgsPoint(cutline_x[0],cutline_y[0])
-            Xs_pt.addZValue()
-            Xs_pt.setZ(Xs.sta_elev.points[0][1])
-            Xs_pt.addMValue()
-            Xs_pt.setM(Xs.sta_elev.points[0][0])
-            Xs_pt_list.append(Xs_pt)
-            # loop through rest of the points
-            for sta_elev in Xs.sta_elev.points[1:-1]:
-                Xs_pt = QgsPoint(cutline_feat.geometry().interpolate(sta_elev[0]).asPoint())
-                Xs_pt.addZValue()
-                Xs_pt.setZ(sta_elev[1])
-                Xs_pt.addMValue()
-                Xs_pt.setM(sta_elev[0])
-                Xs_pt_list.append(Xs_pt)
-                # print(sta_elev)
+            cutline = np.array(Xs.cutline.points, dtype=float)
+            sta_elev = np.array(Xs.sta_elev.points, dtype=float)
             
-            #get last pt separately
-            Xs_pt = QgsPoint(cutline_x[-1],cutline_y[-1])
-            Xs_pt.addZValue()
-            Xs_pt.setZ(Xs.sta_elev.points[-1][1])
-            Xs_pt.addMValue()
-            Xs_pt.setM(Xs.sta_elev.points[-1][0])
-            Xs_pt_list.append(Xs_pt)   
+            # place the stations on the cutline, the first and last points on its ends
+            Xs_x, Xs_y = _station_xy(cutline, sta_elev[:,0])
+            Xs_x[0], Xs_y[0] = cutline[0]
+            Xs_x[-1], Xs_y[-1] = cutline[-1]
             
+            # 3D line with the elevations as Z and the stations as M
+            Xs_line = QgsLineString(Xs_x.tolist(), Xs_y.tolist(), sta_elev[:,1].tolist(), sta_elev[:,0].tolist())
             Xs_feat = QgsFeature()
-            Xs_feat.setGeometry(QgsGeometry.fromPolyline(Xs_pt_list))
+            Xs_feat.setGeometry(QgsGeometry(Xs_line))
             Xs_feat.setAttributes([Xs.header.station.value,Xs.river, Xs.reach])      
-            Xs_file_writer.addFeature(Xs_feat) 
+            Xs_feats.append(Xs_feat)
+        Xs_file_writer.addFeatures(Xs_feats)
                 
         # LOAD REACHES INTO CL SHAPEFILE
         
+        CL_feats = []
         for cur_CL in RAS_geo_obj.get_reaches():    
+            CL_xy = np.array(cur_CL.geo.points, dtype=float)
             CL_feat = QgsFeature()
-            CL_x = [float(x[0]) for x in cur_CL.geo.points]
-            CL_y = [float(x[1]) for x in cur_CL.geo.points]
-            CL_point_list = [QgsPoint(CL_x[i],CL_y[i]) for i in range(len(CL_x))]
-            CL_feat.setGeometry(QgsGeometry.fromPolyline(CL_point_list))
+            CL_feat.setGeometry(QgsGeometry(QgsLineString(CL_xy[:,0].tolist(), CL_xy[:,1].tolist())))
             CL_feat.setAttributes([cur_CL.header.river_name, cur_CL.header.reach_name])  
-            CL_file_writer.addFeature(CL_feat) 
+            CL_feats.append(CL_feat)
+        CL_file_writer.addFeatures(CL_feats)
         
         del(Xs_file_writer)   
         del(CL_file_writer)
-        logging.info("Extraction complete for: " + RAS_geo_file.split("\\")[-1])  
+        logging.info("Extraction complete for: " + g_filename)  
         return True
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
-        logging.error("Error in extracting geometry:" + exc_tb.tb_lineno)
+        logging.error("Error in extracting geometry:" + str(exc_tb.tb_lineno))
         return False
+
+def _station_xy(cutline, stations):
+    """
+    places stations (distances along the cutline) on a cutline by linear referencing, 
+    stations beyond the ends of the cutline are placed on its ends
+
+    Parameters
+    ----------
+    cutline : array (points x 2) of the x, y of the cutline
+    stations : array of stations
+
+    Returns
+    -------
+    x, y : arrays of the coordinates of the stations
+
+    """
+    cutline = np.asarray(cutline, dtype=float)
+    stations = np.asarray(stations, dtype=float)
+    if len(cutline) < 2:
+        return np.full(len(stations), cutline[0,0]), np.full(len(stations), cutline[0,1])
+    
+    # cumulative length of the cutline at its points
+    seg = np.hypot(*np.diff(cutline, axis=0).T)
+    cum = np.concatenate(([0.0], np.cumsum(seg)))
+    
+    # segment of each station and position along it
+    stations = np.clip(stations, 0.0, cum[-1])
+    i = np.clip(np.searchsorted(cum, stations, side="right") - 1, 0, len(seg) - 1)
+    t = np.divide(stations - cum[i], seg[i], out=np.zeros(len(stations)), where=seg[i] > 0)
+    xy = cutline[i] + t[:,None]*(cutline[i+1] - cutline[i])
+    return xy[:,0], xy[:,1]
         
-def RASExtractGeo(file_csv, output_folder):
+def RASExtractGeo(file_csv, output_folder, cache_dir=None):
     """
     reads a list of geo files from csv file and calls RASGeo2Shp to extarct CL and XS
     it then calls RASBoundingPoly to create bounding poly
+    each geo file is parsed once (see RASParseGeo)
 
     Parameters
     ----------
     file_list : csv file containing column "geo" of geo files
         
     output_folder: filepath to folder where all outputs are to be written
+    
+    cache_dir: filepath to folder of the pickled parsed geometries (optional)
 
     Returns
     -------
@@ -319,7 +640,12 @@ def RASExtractGeo(file_csv, output_folder):
 
     """
     df = pd.read_csv(file_csv)
-    for geo_file in df["geo"]:
+    for geo_file in df["geo"].dropna():
+        try:
+            RASParseGeo(geo_file, cache_dir)
+        except Exception:
+            logging.error("Error in parsing geometry file: " + geo_file)
+            continue
         result1 = RASGeo2Shp(geo_file,output_folder)
         result2 = RASBoundingPoly_Simple(geo_file,output_folder)
 
@@ -328,6 +654,8 @@ def RASBoundingPoly_Simple(RAS_geo_file,output_folder):
     """
     Creates a bounding polygon around the XS and saves to shp
     Works for single stream reaches only
+    RAS_geo_file may be the archive path of a geometry file inside zip files, 
+    e.g. outer.zip!/inner.zip!/model.g01, or a parsed geometry (see RASParseGeo)
 
     Returns
     -------
@@ -338,7 +666,7 @@ def RASBoundingPoly_Simple(RAS_geo_file,output_folder):
     """
     try:
         
-        g_filename = os.path.basename(RAS_geo_file).split(".")[0]
+        g_filename = _geo_name(RAS_geo_file)
         out_file_BP = os.path.join(output_folder,g_filename + "_BP.shp")
         ctr=1
         while(os.path.exists(out_file_BP)):
@@ -347,9 +675,9 @@ def RASBoundingPoly_Simple(RAS_geo_file,output_folder):
             ctr=ctr+1
         
         # LOAD RAS GEOMTERY AND GET CRS
-        RAS_geo_obj = prg.ParseRASGeo(RAS_geo_file)
+        RAS_geo_obj = RASParseGeo(RAS_geo_file)
         logging.info("Extracting projection system")
-        epsg_code = RASExtractCRS(RAS_geo_file)
+        epsg_code = RASExtractCRS(RAS_geo_obj)
         
         #get sorted XS list
         xs_list = [(Xs,Xs.header.station.value) for Xs in RAS_geo_obj.get_cross_sections()]
@@ -389,9 +717,12 @@ def RASBoundingPoly_Simple(RAS_geo_file,output_folder):
         
     
 
-def RASExtractWSE(RAS_prj_file,output_file):
+def RASExtractWSE(RAS_prj_file,output_file,version=None):
     """
     extracts wse for all XS for all flows in current plan and writes to csv file
+    
+    The profiles are read at once from the plan HDF file; HEC-RAS (controller) is only 
+    used when the plan has no steady results in HDF.
 
     Parameters
     ----------
@@ -400,6 +731,7 @@ def RASExtractWSE(RAS_prj_file,output_file):
     output_file : filepath (String)
         filepth to a csv file where result to be written 
         (if file already exists, it will be rewritten).
+    version : HEC-RAS version string (optional, default backend.RAS_version_string)
 
     Returns
     -------
@@ -407,12 +739,78 @@ def RASExtractWSE(RAS_prj_file,output_file):
 
     """
     
+    plan_file = utils.current_plan_file(RAS_prj_file)
+    try:
+        cross_sections, profiles, results = RASSteadyResults(plan_file + ".hdf", ["Water Surface"])
+    except (TypeError, OSError, KeyError):
+        logging.warning("No steady results in the plan HDF file of " + RAS_prj_file + ", reading them with HEC-RAS")
+        fin_df = _RASExtractWSE_Controller(RAS_prj_file, version)
+    else:
+        #create dataframe 
+        fin_df = pd.DataFrame(results["Water Surface"], columns=profiles)
+        fin_df["River"] = cross_sections["River"]
+        fin_df["Reach"] = cross_sections["Reach"]
+        fin_df["Xs_ID"] = cross_sections["Xs_ID"]
+    
+    # write to file 
+    fin_df.to_csv(output_file)
+
+def RASSteadyResults(RAS_plan_hdf_file, variables=None):
+    """
+    reads the steady profiles of all XS from a plan HDF file in one pass
+
+    Parameters
+    ----------
+    RAS_plan_hdf_file : filepath (String)
+        filepath to the plan HDF file (e.g. model.p01.hdf).
+    variables : list of variable names (optional, default all the variables in the file)
+        e.g. ["Water Surface", "Energy Grade", "Velocity Channel", "Top Width"]
+
+    Returns
+    -------
+    cross_sections : DataFrame with columns River, Reach and Xs_ID
+    
+    profiles : list of profile names
+    
+    results : dict of {variable name: array (XS x profiles)}, with the dtype of the file
+
+    """
+    with h5py.File(RAS_plan_hdf_file, "r") as f:
+        steady = f[STEADY_PATH]
+        profiles = [p.strip() for p in np.char.decode(steady["Profile Names"][:])]
+        
+        # variables of the XS (profiles x XS), including the additional variables
+        datasets = {}
+        xs_group = steady["Cross Sections"]
+        for group in (xs_group, xs_group.get("Additional Variables")):
+            if group is None:
+                continue
+            for name, item in group.items():
+                if isinstance(item, h5py.Dataset) and item.ndim == 2 and item.shape[0] == len(profiles):
+                    datasets.setdefault(name, item)
+        
+        variables = list(datasets) if variables is None else list(variables)
+        missing = [name for name in variables if name not in datasets]
+        if missing:
+            raise KeyError("Variables not in the steady results of " + RAS_plan_hdf_file + ": " + ", ".join(missing))
+        results = {name: np.ascontiguousarray(datasets[name][:].T) for name in variables}
+        
+        river, reach, xs_id = utils.split_cross_section_names(f[STEADY_XS_PATH][:])
+    
+    cross_sections = pd.DataFrame({"River": river, "Reach": reach, "Xs_ID": xs_id})
+    return cross_sections, profiles, results
+
+def _RASExtractWSE_Controller(RAS_prj_file, version=None):
+    """
+    extracts wse for all XS for all flows in current plan with the HEC-RAS controller 
+    (one call per XS and profile)
+    """
     # layerFields = qgis.core.QgsFields()
     # layerFields.append(qgis.core.QgsField('Xs_ID', QVariant.Double))
     # layerFields.append(qgis.core.QgsField('River', QVariant.String))
     # layerFields.append(qgis.core.QgsField('Reach', QVariant.String))
     # Xs_file_writer = qgis.core.QgsVectorFileWriter(out_file_Xs, 'UTF-8', layerFields, QgsWkbTypes.LineStringZM, QgsCoordinateReferenceSystem('EPSG:' + epsg_code), 'ESRI Shapefile')
-    rc = rascontrol.RasController(version=RAS_version_string)
+    rc = rascontrol.RasController(version=version or backend.RAS_version_string)
     rc.open_project(RAS_prj_file)
     
     cross_sections = rc.simple_xs_list()
@@ -428,11 +826,9 @@ def RASExtractWSE(RAS_prj_file,output_file):
     fin_df["Reach"] = [xs.reach for xs in cross_sections]
     fin_df["Xs_ID"] = [xs.xs_id for xs in cross_sections]  
     
-    # write to file 
-    fin_df.to_csv(output_file)
-    
     # quit ras
     rc.close()
+    return fin_df
     
 # def XS3D2Voronoi(Xs_shp_file):
 #     try:
@@ -15,324 +15,785 @@
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 import os
+import functools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from win32com.client import Dispatch
 import h5py
+import utils
+from backend import session
 
 ## A function to create a 1D unsteady flow data file based on given boundary data
 
 def Py2HecRas_1DU_Flow(ProjectName):
-        """ProjectName is the name (without ".prj") of a HEC-RAS project.
-        """
-    # A function to read the flow hydrograph from the boundary condition CSV files
-    
-    def get_upstream_flow(RiverID,ReachID):
-        # Change the data format for HEC-RAS unsteady flow data file
-        # 10 numbers in each row and 8 placeholders for each data point
-
-        flow_raw_data = pd.read_csv("./1D_Unsteady_BC/BC_"+str(RiverID)+"_"+str(ReachID)+".csv")
-
-        flow_bc = ["Interval=1DAY\n",
-                   "Flow Hydrograph= "+str(len(flow_raw_data))+"\n"]
-
-        for i in range(len(flow_raw_data)):
+    """ProjectName is the name (without ".prj") of a HEC-RAS project.
+       The flow hydrographs and friction slopes are read from ./1D_Unsteady_BC/BC_<RiverID>_<ReachID>.csv
+       and written to ProjectName.u01.
+    """
+    Py2HecRas_1DU_Flow_Batch(ProjectName,[{}],u=1)
+
+## A function to create many 1D unsteady flow data files, one per boundary condition scenario
+
+def Py2HecRas_1DU_Flow_Batch(ProjectName,Scenarios,u=1,GeoFile=None,Folder="./1D_Unsteady_BC/"):
+    """ProjectName is the name (without ".prj") of a HEC-RAS project.
+       Scenarios is a list of scenarios, one per new unsteady flow data file; a scenario is a dict
+                 of {(RiverID, ReachID): flow hydrograph (cfs)} of the upstream boundaries whose flows
+                 differ from the Flow_cfs column of their boundary condition CSV file ({} uses the CSV files)
+       u is the number of the first new unsteady flow data file, the scenarios are written to
+         ProjectName.u(u), ProjectName.u(u+1), ...
+       GeoFile is the geometry file listing the rivers and reaches (default: the geometry of the
+               current plan of the project), no HEC-RAS controller is needed
+       Folder is the folder of the boundary condition CSV files BC_<RiverID>_<ReachID>.csv
+       returns the list of the new unsteady flow data files
+    """
+    _Check_Numbers('u',u,len(Scenarios))
+
+    if GeoFile is None:
+        GeoFile = _Project_Geo(ProjectName)
+
+    # rivers, reaches and river stations (RS) in the order of the geometry file
+    RR = _Read_Geo_Reaches(GeoFile)
+
+    # read each boundary condition CSV file once
+    BC = {}
+
+    def get_bc(RiverID,ReachID):
+        if (RiverID,ReachID) not in BC:
+            BC[(RiverID,ReachID)] = pd.read_csv(os.path.join(Folder,"BC_"+str(RiverID)+"_"+str(ReachID)+".csv"))
+        return BC[(RiverID,ReachID)]
+
+    # the start time of the flow hydrographs and the friction slopes do not change between scenarios
+    Boundaries = []
 
-            temp = "%8.1f"%flow_raw_data["Flow_cfs"][i]
-            flow_bc.append(temp)
-
-            if (i+1)%10 == 0 and i!=len(flow_raw_data)-1:
-                temp = "\n"
-                flow_bc.append(temp)
+    for i in range(len(RR)):
 
-        flow_bc.append("\n")
+        RiverID = RR['River_ID'][i]
+        ReachID = RR['Reach_ID'][i]
+        LRS = RR['River_Station'][i]
 
-        Start_DateTime = pd.to_datetime(flow_raw_data["DateTime"][0])
-        Start_DateTime = Start_DateTime.strftime('%d%b%Y,%H:%M')
+        #for the most upstream RS
+        if ReachID == 1:
+            raw_data = get_bc(RiverID,ReachID)
+            Start_DateTime = pd.to_datetime(raw_data["DateTime"][0]).strftime('%d%b%Y,%H:%M')
+            Boundaries.append(("Boundary Location="+RR['River_Name'][i]+","+RR['Reach_Name'][i]+","+LRS[0]+",\n",
+                               (RiverID,ReachID), raw_data["Flow_cfs"].to_numpy(), Start_DateTime))
 
-        fixed_content = ["DSS Path=\n",
+        #for the most downstream RS
+        elif ReachID == RR['Reach_ID'].max():
+            raw_data = get_bc(RiverID,ReachID)
+            Boundaries.append(("Boundary Location="+RR['River_Name'][i]+","+RR['Reach_Name'][i]+","+LRS[-1]+",\n"
+                               "Friction Slope="+str(raw_data["Friction Slope"][0])+",0\n",
+                               None, None, None))
+
+    UFD_files = []
+
+    for k, Scenario in enumerate(Scenarios):
+
+        Title = ProjectName if len(Scenarios) == 1 else ProjectName+" u"+str(u+k).zfill(2)
+
+        # A list to store the information for the unsteady flow data file
+        UFD_file = ["Flow Title="+Title+"\n",
+                    "Program Version=5.07\n",
+                    "Use Restart= 0\n"]
+
+        for Location, ID, Flow, Start_DateTime in Boundaries:
+            UFD_file.append(Location)
+            if ID is None:
+                continue
+            Flow = Scenario.get(ID, Flow)
+            UFD_file += ["Interval=1DAY\n",
+                         "Flow Hydrograph= "+str(len(Flow))+"\n",
+                         _Format_Hydrograph(Flow),
+                         "DSS Path=\n",
                          "Use DSS=False\n",
                          "Use Fixed Start Time=True\n",
                          "Fixed Start Date/Time="+str(Start_DateTime)+"\n",
                          "Is Critical Boundary=False\n",
                          "Critical Boundary Flow=\n"]
-        flow_bc += fixed_content
-
-        return flow_bc
-
-    # A function to read the friction slope from the boundary condition CSV files
-
-    def get_downstream_fs(RiverID,ReachID):
-
-        fs_raw_data = pd.read_csv("./1D_Unsteady_BC/BC_"+str(RiverID)+"_"+str(ReachID)+".csv")
-
-        fs_bc = ["Friction Slope="+str(fs_raw_data["Friction Slope"][0])+",0\n"]
-
-        return fs_bc
-
-    # Initiate HEC-RAS API
-    hec=Dispatch("RAS507.HECRASController")
-    hec_geo=Dispatch("RAS507.HECRASGeometry")
-
-    ras_file = os.path.join(os.getcwd(),ProjectName+".prj")
-
-    hec.Project_Open(ras_file)
-
-    # Numbers of rivers and the corresponding reaches
-    River_No = hec_geo.nRiver()
-
-    Reach_No = []
-
-    for i in list(range(1,River_No+1)):   
-        Reach_No.append(hec_geo.nReach(i)[0])
 
-    River_ID = []
+        UFD_files.append(ProjectName+".u"+str(u+k).zfill(2))
+
+        with open(UFD_files[-1], "w") as f:
+            f.writelines(UFD_file)
+
+    print(str(len(UFD_files))+" HEC-RAS 1D unsteady flow data files for "+ProjectName+" are done!")
+
+    return UFD_files
+
+## a function to format a flow hydrograph for the HEC-RAS unsteady flow data file
+
+def _Format_Hydrograph(Flow):
+    """returns the lines of the hydrograph, 10 numbers in each row and 8 placeholders for each data point"""
+    values = np.char.mod("%8.1f", np.asarray(Flow, dtype=float))
+    if len(values) == 0:
+        return "\n"
+    # pad to full rows and join the 10 columns of all the rows at once
+    values = np.concatenate((values, np.full(-len(values) % 10, "", dtype=values.dtype))).reshape(-1, 10)
+    rows = functools.reduce(np.char.add, values.T)
+    return "\n".join(rows.tolist())+"\n"
+
+## a function to find the geometry file of the current plan of a project
+
+def _Project_Geo(ProjectName):
+    """returns the geometry file of the current plan of ProjectName.prj
+       (or the first geometry file of the project if the current plan is not found)"""
+    Geo = None
+    Plan = None
+    with open(ProjectName+".prj", "r") as f_prj:
+        for line in f_prj:
+            if line.startswith("Current Plan=") and line.split("=",1)[1].strip():
+                Plan = ProjectName+"."+line.split("=",1)[1].strip()
+            elif line.startswith("Geom File=") and Geo is None:
+                Geo = ProjectName+"."+line.split("=",1)[1].strip()
+
+    if Plan is not None and os.path.exists(Plan):
+        with open(Plan, "r") as f_plan:
+            for line in f_plan:
+                if line.startswith("Geom File="):
+                    return ProjectName+"."+line.split("=",1)[1].strip()
+    if Geo is None:
+        raise ValueError("No geometry file in "+ProjectName+".prj")
+    return Geo
+
+## a function to read the rivers, reaches and river stations of a geometry file
+
+def _Read_Geo_Reaches(GeoFile):
+    """returns a dataframe of ID and name of the river and the reach, and the list of the
+       river stations (all node types, upstream to downstream) of each reach"""
+    Net = utils.read_network(GeoFile)
+
+    # number the rivers in order of appearance, and the reaches within each river
+    River_ID = Net.reach_river+1
+    Reach_ID = [int(np.sum(Net.reach_river[:i] == r))+1 for i, r in enumerate(Net.reach_river)]
+
+    RR = pd.DataFrame({'River_ID': River_ID, 'Reach_ID': Reach_ID,
+                       'River_Name': Net.rivers[Net.reach_river], 'Reach_Name': Net.reach_names,
+                       'River_Station': [Net.river_stations(i) for i in range(len(Net))]})
+    RR = RR.sort_values(['River_ID','Reach_ID'], kind='stable').reset_index(drop=True)
+    return RR
+
+## a function to check the numbers of new files of a project
+
+def _Check_Numbers(Kind,First,Count):
+    """raises a ValueError if the files Kind(First) to Kind(First+Count-1), e.g. g05 to g12,
+       are not numbered from 01 to 99 as HEC-RAS projects require"""
+    Last = First+Count-1
+    if Count > 0 and (First < 1 or Last > 99):
+        Files = Kind+str(First).zfill(2)+(" to "+Kind+str(Last).zfill(2) if Count > 1 else "")
+        raise ValueError("HEC-RAS files are numbered from "+Kind+"01 to "+Kind+"99, not "+Files)
 
-    for i in list(range(1,River_No+1)): 
-        River_ID += [i]*Reach_No[i-1]
-        
-    Reach_ID = []
-
-    for i in Reach_No: 
-        Reach_ID += list(range(1,i+1))
+## a function to modify the Manning's n (multiply factor is given) in the original geometry file
+## and generate a new geometry file with new Manning's n
 
-    # create a dataframe to store ID of river and its corresponding ID of reach
-    RR = pd.DataFrame(None,columns=['River_ID','Reach_ID'])
-    RR['River_ID'] = River_ID
-    RR['Reach_ID'] = Reach_ID
+def Py2HecRas_1DU_Geo(fl,fc,fr,ProjectName,g):
+    """fl is the multiply factor for the LOB Manning's n
+       fc is the multiply factor for the Channel Manning's n
+       fr is the multiply factor for the ROB Manning's n
+       g is the new number of geometry files
+       The new geometry file is written from the initial geometry file (number is 99),
+       which is not modified.
+       """
+    _Check_Numbers('g',g,1)
+    Py2HecRas_1DU_MN(fl,fc,fr,ProjectName+'.g99',ProjectName+'.g'+str(g).zfill(2))
 
-    River_Name = []
-    Reach_Name = []
+    print("HEC-RAS 1D geometry file for "+ProjectName+" is done!")
 
-    for i in range(len(RR)):
-            
-        River_Name.append(hec_geo.RiverName(RR['River_ID'][i])[0])
-        Reach_Name.append(hec_geo.ReachName(RR['River_ID'][i],RR['Reach_ID'][i])[0])
-            
-    # create a dataframe to store Names of river and its corresponding names of reach
-    RRname = pd.DataFrame(None, columns=['River_Name','Reach_Name'])
-    RRname['River_Name'] = River_Name
-    RRname['Reach_Name'] = Reach_Name
+## a function to write a copy of a geometry file with the Manning's n of the cross sections
+## multiplied by given factors, without the HEC-RAS controller
 
-    # A list to store the information for the unsteady flow data file
+def Py2HecRas_1DU_MN(fl,fc,fr,GeoFile,NewGeoFile):
+    """fl, fc and fr are the multiply factors for the LOB, Channel and ROB Manning's n
+       GeoFile is the geometry file (.g##) to read, it is not modified
+       NewGeoFile is the new geometry file to write
+       The n values left of the left bank station are multiplied by fl, those from the left
+       bank to the right bank station by fc and those from the right bank station by fr.
+       Only cross sections are modified, as by the HEC-RAS controller (Geometry_SetMann_LChR).
+       """
+    if os.path.abspath(GeoFile) == os.path.abspath(NewGeoFile):
+        raise ValueError("The new geometry file must be different from "+GeoFile)
+
+    # keep the line endings of the original file
+    with open(GeoFile, 'r', newline='') as f_old:
+        _Write_Geo_Variant(_Read_Geo_Mann(f_old),NewGeoFile,fl,fc,fr)
+
+## a function to generate many geometry files with the Manning's n multiplied by a table of factors
+
+def Py2HecRas_1DU_Geo_Batch(Factors,ProjectName,g=1,BaseGeo=None,Mask=None,processes=None,Manifest=None):
+    """Factors is the table of multiply factors, one row per new geometry file: a DataFrame
+               with the columns fl, fc and fr or a list of (fl, fc, fr)
+       g is the number of the first new geometry file, the rows of Factors are written
+         to ProjectName.g(g), ProjectName.g(g+1), ...
+       BaseGeo is the geometry file to read (default: ProjectName.g99), it is parsed once
+       Mask selects the cross sections to modify: a list of (River, Reach) or (River, Reach, RS)
+            or a function f(River, Reach, RS) returning True for the cross sections to modify
+            (default: all the cross sections)
+       processes is the number of worker processes (default: number of cores)
+       Manifest is the CSV file to save the manifest to (optional)
+       returns the manifest, a DataFrame of the geometry file and fl, fc and fr of each new file
+       HEC-RAS projects hold at most 99 geometry files, so larger tables need several projects.
+       On Windows, call it under if __name__ == '__main__':
+       """
+    if BaseGeo is None:
+        BaseGeo = ProjectName+'.g99'
 
-    UFD_file = ["Flow Title="+ProjectName+"\n",
-                "Program Version=5.07\n",
-                "Use Restart= 0\n"]
+    if isinstance(Factors, pd.DataFrame):
+        Factors = Factors[['fl','fc','fr']].to_numpy(dtype=float)
+    Factors = np.asarray(Factors, dtype=float).reshape(-1, 3)
+    _Check_Numbers('g',g,len(Factors))
 
-    for i in range(len(RR)):
-            
-        RiverName = RRname['River_Name'][i]
-        ReachName = RRname['Reach_Name'][i]
-        
-        #read information of river stations: number of river station (NRS), list of RS (LRS) and type of RS (TRS)
-        RiverID = RR['River_ID'][i]
-        ReachID = RR['Reach_ID'][i]
+    # parse the base geometry file once
+    with open(BaseGeo, 'r', newline='') as f_old:
+        items = list(_Read_Geo_Mann(f_old))
 
-        _,_,_,LRS,_ = hec.Geometry_GetNodes(RiverID,ReachID)
+    # mark the cross sections to modify
+    if Mask is not None:
+        if callable(Mask):
+            selected = Mask
+        else:
+            Mask = set(tuple(str(v).strip() for v in m) for m in Mask)
+            selected = lambda River, Reach, RS: (River, Reach) in Mask or (River, Reach, RS) in Mask
+        for item in items:
+            if not isinstance(item, str):
+                item['mask'] = bool(selected(item['River'], item['Reach'], item['RS']))
 
-        #for the most upstream RS
-        if ReachID == 1:
-            Upstream_RS = LRS[0]
-            UFD_file.append("Boundary Location="+RiverName+","+ReachName+","+Upstream_RS+",\n")
-            UFD_file += get_upstream_flow(RiverID,ReachID)
+    GeoFiles = [ProjectName+'.g'+str(g+i).zfill(2) for i in range(len(Factors))]
+    if os.path.abspath(BaseGeo) in [os.path.abspath(f) for f in GeoFiles]:
+        raise ValueError("The new geometry files must be different from "+BaseGeo)
 
-        #for the most downstream RS
-        elif ReachID == RR['Reach_ID'].max():
-            Downstream_RS = LRS[-1]
-            UFD_file.append("Boundary Location="+RiverName+","+ReachName+","+Downstream_RS+",\n")
-            UFD_file += get_downstream_fs(RiverID,ReachID)
+    # write the new geometry files in parallel, each worker receives the parsed file once
+    with ProcessPoolExecutor(max_workers=processes, initializer=_Geo_Batch_Init, initargs=(items,)) as executor:
+        list(executor.map(_Geo_Batch_Write, GeoFiles, Factors[:,0], Factors[:,1], Factors[:,2]))
 
-    f = open(ProjectName+".u01", "w")
+    manifest = pd.DataFrame({'Geom File': [os.path.basename(f) for f in GeoFiles],
+                             'fl': Factors[:,0], 'fc': Factors[:,1], 'fr': Factors[:,2]})
+    if Manifest:
+        manifest.to_csv(Manifest, index=False)
 
-    f.writelines(UFD_file)
+    print(str(len(GeoFiles))+" HEC-RAS 1D geometry files for "+ProjectName+" are done!")
 
-    f.close()
+    return manifest
 
-    # close HEC-RAS Project and quit
-    hec.Project_Close()
-    hec.QuitRas()
+# parsed base geometry file of the worker processes of Py2HecRas_1DU_Geo_Batch
+_GEO_ITEMS = None
 
-    # delete HEC-RAS controller
-    del hec
-    del hec_geo
+def _Geo_Batch_Init(items):
+    global _GEO_ITEMS
+    _GEO_ITEMS = items
 
-    print("HEC-RAS 1D unsteady flow data file for "+ProjectName+" is done!")
+def _Geo_Batch_Write(NewGeoFile,fl,fc,fr):
+    _Write_Geo_Variant(_GEO_ITEMS,NewGeoFile,fl,fc,fr)
 
-## a function to modify the Manning's n (multiply factor is given) in the original geometry file
-## and generate a new geometry file with new Manning's n
+## a function to write a geometry file from the items of _Read_Geo_Mann with new Manning's n
 
-def Py2HecRas_1DU_Geo(fl,fc,fr,ProjectName,g):
-    """fl is the multiply factor for the LOB Manning's n
-       fc is the multiply factor for the LOB Manning's n
-       fr is the multiply factor for the LOB Manning's n
-       g is the new number of geometry files
+def _Write_Geo_Variant(items,NewGeoFile,fl,fc,fr):
+    """items is an iterable of the lines and Manning's n blocks yielded by _Read_Geo_Mann,
+       blocks with a False 'mask' key are written unchanged
        """
-    # a function to modify the Manning's n (multiply factor is given) in the original geometry file
-    def Py2HecRas_1DU_MN(fl,fc,fr,ProjectName,g):
-        # Initiate HEC-RAS API
-        hec=Dispatch("RAS507.HECRASController")
-        hec_geo=Dispatch("RAS507.HECRASGeometry")
-
-        ras_file = os.path.join(os.getcwd(),ProjectName+".prj")
-
-        hec.Project_Open(ras_file)
-
-        # Numbers of rivers and the corresponding reaches
-        River_No = hec_geo.nRiver()
-
-        Reach_No = []
-
-        for i in list(range(1,River_No+1)):   
-            Reach_No.append(hec_geo.nReach(i)[0])
-
-        River_ID = []
-
-        for i in list(range(1,River_No+1)): 
-            River_ID += [i]*Reach_No[i-1]
-            
-        Reach_ID = []
-
-        for i in Reach_No: 
-            Reach_ID += list(range(1,i+1))
-
-        # create a dataframe to store ID of river and its corresponding ID of reach
-        RR = pd.DataFrame(None,columns=['River_ID','Reach_ID'])
-        RR['River_ID'] = River_ID
-        RR['Reach_ID'] = Reach_ID
-
-        River_Name = []
-        Reach_Name = []
-        RS=[]
-        RS_type=[]
-
-        for i in range(len(RR)):
-            #read information of river stations: list of RS (LRS) and type of RS (TRS)
-
-            _,_,_,LRS,TRS = hec.Geometry_GetNodes(RR['River_ID'][i],RR['Reach_ID'][i])
-
-            for j in range(len(LRS)):    
-                
-                River_Name.append(hec_geo.RiverName(RR['River_ID'][i])[0])
-                Reach_Name.append(hec_geo.ReachName(RR['River_ID'][i],RR['Reach_ID'][i])[0])
-                RS.append(LRS[j])
-                RS_type.append(TRS[j])
-                
-        # create a dataframe to store Names of river and its corresponding names of reach and River stations
-        RRRS = pd.DataFrame(None, columns=['River_Name','Reach_Name','River_Station','RS_Type'])
-        RRRS['River_Name'] = River_Name
-        RRRS['Reach_Name'] = Reach_Name
-        RRRS['River_Station'] = RS
-        RRRS['RS_Type'] = RS_type
-
-        for i in range(len(RRRS)):
-            # get the simple river station instead of hydraulic structures
-            if RRRS['RS_Type'][i] == "":
-                # get the original Manning's values for LOB, Channel, and ROB
-                ini_n = hec.Geometry_GetMann(RRRS['River_Name'][i],
-                                             RRRS['Reach_Name'][i],
-                                             RRRS['River_Station'][i])[5]
-
-                # assign the new Manning's values for LOB, Channel, and ROB
-                new_ln = fl*ini_n[0]
-                new_cn = fc*ini_n[1]
-                new_rn = fr*ini_n[2]
-
-                hec.Geometry_SetMann_LChR(RRRS['River_Name'][i],
-                                          RRRS['Reach_Name'][i],
-                                          RRRS['River_Station'][i],
-                                          new_ln,new_cn,new_rn)
-        
-        hec_geo.Save()
-
-        hec.Project_Close()
-        hec.QuitRas()
-
-        del hec
-        del hec_geo
-
-    Py2HecRas_1DU_MN(fl,fc,fr,ProjectName,g)
-    
-    # read the initial geometry file (number is 99)
-    f_old = open(ProjectName+'.g99','r')
-    # write the new geometry data file
-    f_new = open(ProjectName+'.g'+str(g).zfill(2),'w')
-
-    for line in f_old:
-        f_new.write(line)
+    factors = np.array([fl,fc,fr], dtype=float)
+    with open(NewGeoFile, 'w', newline='') as f_new:
+        for item in items:
+            if isinstance(item, str):
+                f_new.write(item)
+            elif item.get('mask', True):
+                f_new.writelines(_Write_Mann_Block(item, item['n']*factors[item['side']]))
+            else:
+                f_new.writelines(item['lines'])
+
+# width of the fields of the data blocks of HEC-RAS geometry files
+GEO_FIELD = 8
+
+## a function to read a geometry file line by line, grouping the lines of the Manning's n
+## of each cross section
+
+def _Read_Geo_Mann(lines):
+    """lines is an iterable of the lines of a geometry file (e.g. an open file)
+       yields the lines, except that the lines from "#Mann=" to "Bank Sta=" of a cross section
+       are yielded as one dict with the keys
+       River, Reach, RS : the cross section
+       lines : the lines of the block
+       fields : the (line, start of field) of each n value
+       n : array of the n values
+       side : array of 0 (LOB), 1 (Channel) or 2 (ROB) for each n value
+       """
+    River = Reach = RS = ""
+    node_type = 0
+    block = None
+
+    def close(block, bank=None):
+        # station of each n value, relative to the bank stations
+        stations = np.array(block.pop('stations'))
+        if bank is not None:
+            block['side'] = (stations >= bank[0]).astype(int) + (stations >= bank[1]).astype(int)
+        else:
+            # no bank stations, use the channel factor
+            block['side'] = np.ones(len(stations), dtype=int)
+        block['n'] = np.array(block['n'])
+        return block
+
+    for line in lines:
+        if block is not None:
+            if len(block['n']) < block['count']:
+                # values are written as (station, n, 0) triplets in fixed width fields
+                values = line.rstrip('\r\n')
+                for start in range(0, len(values), GEO_FIELD):
+                    k = block['k']
+                    if k//3 < block['count']:
+                        if k%3 == 0:
+                            block['stations'].append(float(values[start:start+GEO_FIELD]))
+                        elif k%3 == 1:
+                            block['n'].append(float(values[start:start+GEO_FIELD]))
+                            block['fields'].append((len(block['lines']), start))
+                    block['k'] = k+1
+                block['lines'].append(line)
+                continue
+            elif line.startswith('Bank Sta='):
+                block['lines'].append(line)
+                bank = [float(v) for v in line.split('=',1)[1].split(',')[:2]]
+                yield close(block, bank)
+                block = None
+                continue
+            elif not (line.startswith('Type RM Length') or line.startswith('River Reach=')):
+                block['lines'].append(line)
+                continue
+            else:
+                yield close(block)
+                block = None
+
+        if line.startswith('River Reach='):
+            River, Reach = [v.strip() for v in line.split('=',1)[1].split(',')[:2]]
+            node_type = 0
+        elif line.startswith('Type RM Length'):
+            values = line.split('=',1)[1].split(',')
+            node_type = int(values[0])
+            RS = values[1].strip()
+        elif line.startswith('#Mann=') and node_type == 1:
+            block = {'River': River, 'Reach': Reach, 'RS': RS,
+                     'count': int(line.split('=',1)[1].split(',')[0]),
+                     'lines': [line], 'fields': [], 'stations': [], 'n': [], 'k': 0}
+            continue
+        yield line
+
+    if block is not None:
+        yield close(block)
+
+## a function to write the lines of a Manning's n block with new n values
+
+def _Write_Mann_Block(block,n):
+    """block is a dict yielded by _Read_Geo_Mann
+       n is the array of the new n values
+       returns the lines of the block with the new n values
+       """
+    lines = list(block['lines'])
+    for (i, start), value in zip(block['fields'], n):
+        lines[i] = lines[i][:start] + _Geo_Field(value) + lines[i][start+GEO_FIELD:]
+    return lines
 
-    f_old.close()
-    f_new.close()
+## a function to format a number in a fixed width field of a geometry file
 
-    # restore the origial geometry file
-    Py2HecRas_1DU_MN(1/fl,1/fc,1/fr,ProjectName,g=99)
-    
-    print("HEC-RAS 1D geometry file for "+ProjectName+" is done!")
+def _Geo_Field(value,width=GEO_FIELD):
+    """returns value right-aligned in width characters with as many decimals as fit,
+       without the leading zero (e.g. "   .0385"), as written by HEC-RAS
+       """
+    for decimals in range(width-1, -1, -1):
+        text = "%.*f" % (decimals, value)
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+        if text.startswith('0.'):
+            text = text[1:]
+        elif text.startswith('-0.'):
+            text = '-' + text[2:]
+        if len(text) <= width:
+            return text.rjust(width)
+    raise ValueError("Value "+str(value)+" does not fit in "+str(width)+" characters")
 
 
 ## a function to Modify the original project file
 
 def Py2HecRas_1DU_Project(u,g,p,ProjectName):
-    """u is the added number of unsteady flow data files
-       g is the added number of geometry files
-       p is the added number of plan files
+    """u is the added number of unsteady flow data files (or a list of them, 0 for none)
+       g is the added number of geometry files (or a list of them, 0 for none)
+       p is the added number of plan files (or a list of them, 0 for none)
+       Files already in the project file are not added again, and the project file is
+       written once, atomically.
        """
-    # list of the added unsteady flow data file
-    uf = "Unsteady File=u"+str(u).zfill(2)+"\n"
+    prj = ProjectFile.Read(ProjectName+".prj")
 
-    # list of the added plan file
-    pf = "Plan File=p"+str(p).zfill(2)+"\n"
+    for Kind, Numbers in (("g", g), ("u", u), ("p", p)):
+        for Number in ([Numbers] if np.isscalar(Numbers) else Numbers):
+            if Number != 0:
+                prj.Register(Kind, Number)
 
-    if g != 0:
-        gf = "Geom File=g"+str(g).zfill(2)+"\n"
-    else:
-        gf = ""
-
-    # Modify the original project file
-
-    f_prj = open(ProjectName+".prj", "r")
+    prj.Write()
 
-    prj_contents = f_prj.readlines()
-
-    f_prj.close()
-
-    f_prj = open(ProjectName+".prj", "w")
+    print("HEC-RAS 1D unsteady project file for "+ProjectName+" is done!")
 
-    if gf:
-        prj_contents.insert(4,gf+uf+pf)
-    else:
-        prj_contents.insert(4,uf+pf)
+## a class to read, modify and write HEC-RAS project files (.prj)
 
-    f_prj.writelines(prj_contents)
+class ProjectFile:
+    """ProjectFile keeps the lines of a project file and the files registered in it
+       (e.g. "Geom File=g01", "Unsteady File=u01", "Plan File=p01").
+       Register() adds files in memory, ignoring the ones already registered, next to the
+       files of the same kind; Write() saves the project file once, atomically (to a
+       temporary file renamed over the project file).
+       """
 
-    f_prj.close()
+    # keys of the registered files, by the letter of their extension
+    FILE_KEYS = {"g": "Geom File",
+                 "f": "Flow File",
+                 "u": "Unsteady File",
+                 "q": "QuasiSteady File",
+                 "p": "Plan File"}
+
+    def __init__(self,FileName,lines):
+        self.FileName = FileName
+        self.lines = list(lines)
+        # keep the line endings of the project file
+        self.newline = "\r\n" if self.lines and self.lines[0].endswith("\r\n") else "\n"
+        # registered (key, file) and index of the last line of each key, updated by Register
+        self._registered = set()
+        self._last = {}
+        for i, line in enumerate(self.lines):
+            key = self._Key(line)
+            if key:
+                self._registered.add((key, line.partition("=")[2].strip()))
+                self._last[key] = i
+
+    @classmethod
+    def Read(cls,FileName):
+        with open(FileName, 'r', newline='') as f:
+            return cls(FileName, f.readlines())
+
+    def _Key(self,line):
+        key, _, value = line.partition("=")
+        return key if key in self.FILE_KEYS.values() else None
+
+    def Files(self,Kind):
+        """Kind is the letter of the file type, e.g. "p"
+           returns the list of the registered files of that type, e.g. ["p01", "p02"]"""
+        key = self.FILE_KEYS[Kind]
+        return [line.partition("=")[2].strip() for line in self.lines if self._Key(line) == key]
+
+    def LastNumber(self,Kind):
+        """returns the largest number of the registered files of a type (0 if there is none)"""
+        numbers = [int(f[1:]) for f in self.Files(Kind) if f[1:].isdigit()]
+        return max(numbers, default=0)
+
+    def Register(self,Kind,Number):
+        """Kind is the letter of the file type ("g", "f", "u", "q" or "p")
+           Number is the number of the file
+           returns False if the file was already registered"""
+        key = self.FILE_KEYS[Kind]
+        name = Kind+str(Number).zfill(2)
+        if (key, name) in self._registered:
+            return False
+
+        # after the last file of the same kind, else after the last registered file,
+        # else after the header of the project file
+        if key in self._last:
+            at = self._last[key]+1
+        elif self._last:
+            at = max(self._last.values())+1
+        else:
+            at = min(4, len(self.lines))
+        self.lines.insert(at, key+"="+name+self.newline)
+
+        # the lines after the new one move down
+        for k, i in self._last.items():
+            if i >= at:
+                self._last[k] = i+1
+        self._last[key] = at
+        self._registered.add((key, name))
+        return True
+
+    def Write(self,FileName=None):
+        FileName = FileName or self.FileName
+        folder = os.path.dirname(os.path.abspath(FileName))
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=folder)
+        try:
+            with os.fdopen(fd, 'w', newline='') as f:
+                f.writelines(self.lines)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(FileName):
+                # keep the permissions of the project file
+                mode = os.stat(FileName).st_mode & 0o7777
+            else:
+                # permissions of a new file (mkstemp creates it readable by its owner only)
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(tmp_file, mode)
+            os.replace(tmp_file, FileName)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+## the template of a HEC-RAS 1D unsteady flow plan file
+
+TEMPLATE_1DU_PLAN = ['Plan Title=tempate_uf\n',
+                     'Program Version=5.07\n',
+                     'Short Identifier=unsteadyflow                                                              \n',
+                     'Simulation Date=01JAN2008,00:00,07JAN2008,00:00\n',
+                     'Geom File=g01\n',
+                     'Flow File=u01\n',
+                     'Subcritical Flow\n',
+                     'K Sum by GR= 0 \n',
+                     'Std Step Tol= .01 \n',
+                     'Critical Tol= .01 \n',
+                     'Num of Std Step Trials= 20 \n',
+                     'Max Error Tol= .3 \n',
+                     'Flow Tol Ratio= .001 \n',
+                     'Split Flow NTrial= 30 \n',
+                     'Split Flow Tol= .02 \n',
+                     'Split Flow Ratio= .02 \n',
+                     'Log Output Level= 0 \n',
+                     'Friction Slope Method= 1 \n',
+                     'Unsteady Friction Slope Method= 2 \n',
+                     'Unsteady Bridges Friction Slope Method= 1 \n',
+                     'Parabolic Critical Depth\n',
+                     'Global Vel Dist= 0 , 0 , 0 \n',
+                     'Global Log Level= 0 \n',
+                     'CheckData=True\n',
+                     'Encroach Param=-1 ,0,0, 0 \n',
+                     'Computation Interval=1HOUR\n',
+                     'Output Interval=1DAY\n',
+                     'Instantaneous Interval=1DAY\n',
+                     'Mapping Interval=1DAY\n',
+                     'Computation Time Step Use Courant=        0\n',
+                     'Computation Time Step Use Time Series=    0\n',
+                     'Computation Time Step Max Courant=\n',
+                     'Computation Time Step Min Courant=\n',
+                     'Computation Time Step Count To Double=0\n',
+                     'Computation Time Step Max Doubling=0\n',
+                     'Computation Time Step Max Halving=0\n',
+                     'Computation Time Step Residence Courant=0\n',
+                     'Run HTab=-1 \n',
+                     'Run UNet=-1 \n',
+                     'Run Sediment= 0 \n',
+                     'Run PostProcess= 0 \n',
+                     'Run WQNet= 0 \n',
+                     'Run RASMapper=-1 \n',
+                     'UNET Theta= 1 \n',
+                     'UNET Theta Warmup= 1 \n',
+                     'UNET ZTol= .02 \n',
+                     'UNET ZSATol= .02 \n', 'UNET QTol=\n',
+                     'UNET MxIter= 20 \n',
+                     'UNET Max Iter WO Improvement= 0 \n',
+                     'UNET MaxInSteps= 0 \n',
+                     'UNET DtIC= 0 \n',
+                     'UNET DtMin= 0 \n',
+                     'UNET MaxCRTS= 20 \n',
+                     'UNET WFStab= 2 \n',
+                     'UNET SFStab= 1 \n',
+                     'UNET WFX= 1 \n',
+                     'UNET SFX= 1 \n',
+                     'UNET 1D Methodology=Finite Difference\n',
+                     'UNET DSS MLevel= 4 \n', 'UNET Pardiso=0\n',
+                     'UNET DZMax Abort= 100 \n',
+                     'UNET Use Existing IB Tables=-1 \n',
+                     'UNET Froude Reduction=False\n',
+                     'UNET Froude Limit= .8 \n',
+                     'UNET Froude Power= 4 \n',
+                     'UNET D1 Cores= 0 \n',
+                     'UNET D2 Coriolis=0\n',
+                     'UNET D2 Cores= 0 \n',
+                     'UNET D2 Theta= 1 \n',
+                     'UNET D2 Theta Warmup= 1 \n',
+                     'UNET D2 Z Tol= .01 \n',
+                     'UNET D2 Volume Tol= .01 \n',
+                     'UNET D2 Max Iterations= 20 \n',
+                     'UNET D2 Equation= 0 \n',
+                     'UNET D2 TotalICTime=\n',
+                     'UNET D2 RampUpFraction=.1\n',
+                     'UNET D2 TimeSlices= 1 \n',
+                     'UNET D2 Eddy Viscosity=\n',
+                     'UNET D2 BCVolumeCheck=0\n',
+                     'UNET D2 Latitude=\n',
+                     'UNET D1D2 MaxIter= 0 \n',
+                     'UNET D1D2 ZTol=.01\n',
+                     'UNET D1D2 QTol=.1\n',
+                     'UNET D1D2 MinQTol=1\n',
+                     'DSS File=dss\n',
+                     'Write IC File= 0 \n',
+                     'Write IC File at Fixed DateTime=0\n',
+                     'IC Time=,,\n',
+                     'Write IC File Reoccurance=\n',
+                     'Write IC File at Sim End=0\n',
+                     'Echo Input=False\n',
+                     'Echo Parameters=False\n',
+                     'Echo Output=False\n',
+                     'Write Detailed= 0 \n',
+                     'HDF Write Warmup=0\n',
+                     'HDF Write Time Slices=0\n',
+                     'HDF Flush=0\n',
+                     'HDF Face Node Velocities=0\n',
+                     'HDF Compression= 1 \n',
+                     'HDF Chunk Size= 1 \n',
+                     'HDF Spatial Parts= 1 \n',
+                     'HDF Use Max Rows=0\n',
+                     'HDF Fixed Rows= 1 \n',
+                     'Calibration Method= 0 \n',
+                     'Calibration Iterations= 20 \n',
+                     'Calibration Max Change=.05\n',
+                     'Calibration Tolerance=.2\n',
+                     'Calibration Maximum=1.5\n',
+                     'Calibration Minimum=.5\n',
+                     'Calibration Optimization Method= 1 \n',
+                     'Calibration Window=,,,\n',
+                     'WQ AD Non Conservative\n',
+                     'WQ ULTIMATE=-1\n',
+                     'WQ Max Comp Step=1HOUR\n',
+                     'WQ Output Interval=15MIN\n',
+                     'WQ Output Selected Increments= 0 \n',
+                     'WQ Output face flow=0\n',
+                     'WQ Output face velocity=0\n',
+                     'WQ Output face area=0\n',
+                     'WQ Output face dispersion=0\n',
+                     'WQ Output cell volume=0\n',
+                     'WQ Output cell surface area=0\n',
+                     'WQ Output cell continuity=0\n',
+                     'WQ Output cumulative cell continuity=0\n',
+                     'WQ Output face conc=0\n',
+                     'WQ Output face dconc_dx=0\n',
+                     'WQ Output face courant=0\n',
+                     'WQ Output face peclet=0\n',
+                     'WQ Output face adv mass=0\n',
+                     'WQ Output face disp mass=0\n',
+                     'WQ Output cell mass=0\n',
+                     'WQ Output cell source sink temp=0\n',
+                     'WQ Output nsm pathways=0\n',
+                     'WQ Output nsm derived pathways=0\n',
+                     'WQ Output MaxMinRange=-1\n',
+                     'WQ Daily Max Min Mean=-1\n',
+                     'WQ Daily Range=0\n',
+                     'WQ Daily Time=0\n',
+                     'WQ Create Restart=0\n',
+                     'WQ Fixed Restart=0\n',
+                     'WQ Restart Simtime=\n',
+                     'WQ Restart Date=\n',
+                     'WQ Restart Hour=\n',
+                     'WQ System Summary=0\n',
+                     'WQ Write To DSS=0\n',
+                     'WQ Use Fixed Temperature=0\n',
+                     'WQ Fixed Temperature=\n',
+                     'Sorting and Armoring Iterations= 10 \n',
+                     'XS Update Threshold= .02 \n',
+                     'Bed Roughness Predictor= 0 \n',
+                     'Hydraulics Update Threshold= .02 \n',
+                     'Energy Slope Method= 1 \n',
+                     'Volume Change Method= 1 \n',
+                     'Sediment Retention Method= 0 \n',
+                     'XS Weighting Method= 0 \n',
+                     'Number of US Weighted Cross Sections= 1 \n',
+                     'Number of DS Weighted Cross Sections= 1 \n',
+                     'Upstream XS Weight=0\n', 'Main XS Weight=1\n',
+                     'Downstream XS Weight=0\n',
+                     "Number of DS XS's Weighted with US Boundary= 1 \n",
+                     'Upstream Boundary Weight= 1 \n',
+                     'Weight of XSs Associated with US Boundary= 0 \n',
+                     "Number of US XS's Weighted with DS Boundary= 1 \n",
+                     'Downstream Boundary Weight= .5 \n',
+                     'Weight of XSs Associated with DS Boundary= .5 \n',
+                     'Percentile Method= 0 \n',
+                     'Sediment Output Level= 3 \n',
+                     'Mass or Volume Output= 0 \n',
+                     'Output Increment Type= 1 \n',
+                     'Profile and TS Output Increment= 1 \n',
+                     'XS Output Flag= 0 \n',
+                     'XS Output Increment= 10 \n',
+                     'Write Gradation File= 0 \n',
+                     'Read Gradation Hotstart= 0 \n',
+                     'Gradation File Name=\n',
+                     'Write HDF5 File= 1 \n',
+                     'Write Binary Output= 1 \n',
+                     'Write DSS Sediment File= 0 \n',
+                     'SV Curve= 0 \n',
+                     'Specific Gage Flag= 0 \n']
+
+## a class to read, modify and write HEC-RAS plan files (.p##)
+
+class PlanFile:
+    """PlanFile keeps the lines of a plan file as an ordered list of [key, value] entries,
+       e.g. "Computation Interval=1HOUR" is ["Computation Interval", "1HOUR"], and lines
+       without "=" (e.g. "Subcritical Flow") are kept with a value of None.
+       Values are read and set by their exact key, e.g. plan["Output Interval"] = "1DAY"
+       does not change "WQ Output Interval". New keys are added at the end.
+       """
 
-    print("HEC-RAS 1D unsteady project file for "+ProjectName+" is done!")
+    def __init__(self,lines=()):
+        self.entries = []
+        self.keys = {}
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if '=' in line:
+                key, value = line.split('=',1)
+            else:
+                key, value = line, None
+            self._Append(key, value)
+
+    @classmethod
+    def Read(cls,FileName):
+        with open(FileName, 'r') as f:
+            return cls(f)
+
+    def _Append(self,key,value):
+        # the first entry of a key is the one read and set
+        if key not in self.keys:
+            self.keys[key] = len(self.entries)
+        self.entries.append([key, value])
+
+    def __getitem__(self,key):
+        return self.entries[self.keys[key]][1]
+
+    def __setitem__(self,key,value):
+        if key in self.keys:
+            self.entries[self.keys[key]][1] = value
+        else:
+            self._Append(key, value)
+
+    def __contains__(self,key):
+        return key in self.keys
+
+    def Update(self,values):
+        """values is a dict of {key: new value}"""
+        for key, value in values.items():
+            self[key] = value
+
+    def Copy(self):
+        plan = PlanFile()
+        plan.entries = [list(entry) for entry in self.entries]
+        plan.keys = dict(self.keys)
+        return plan
+
+    def Lines(self):
+        return [key+"\n" if value is None else key+"="+value+"\n" for key, value in self.entries]
+
+    def Write(self,FileName):
+        with open(FileName, 'w') as f:
+            f.writelines(self.Lines())
 
 ## a function to formulate several plan files
 # by selecting a specific set of geometry data and unsteady flow data file
 
-def Py2HecRas_1DU_Plan(g,u,StartDateTime,EndDateTime,CI="1HOUR",HI="1DAY",MI="1DAY",DI="1DAY",ProjectName="test"):
-    """g is the number of geometry data files
-       u is the number of unsteady flow data files
+def Py2HecRas_1DU_Plan(g,u,StartDateTime,EndDateTime,CI="1HOUR",HI="1DAY",MI="1DAY",DI="1DAY",ProjectName="test",Template=None):
+    """g is the number of geometry data files (g01 to g##), or a list of their numbers
+       u is the number of unsteady flow data files (u01 to u##), or a list of their numbers
        StartDateTime is the starting simulation datetime(YYYY-MM-DD,HH:mm)
        EndDateTime is the ending simulation datetime(YYYY-MM-DD,HH:mm)
        CI is computation interval
        HI is hydrograph output interval
        MI is mapping output interval
        DI is detailed output interval
+       Template is a plan file (.p##) to use as template (default: TEMPLATE_1DU_PLAN)
+       A plan file is written for every combination of geometry and unsteady flow data file,
+       numbered after the last plan file of ProjectName.prj (at most p99); no HEC-RAS
+       controller is needed.
+       returns the list of the new plan files
        """
-    # Initiate HEC-RAS API
-    hec=Dispatch("RAS507.HECRASController")
-    ras_file = os.path.join(os.getcwd(),ProjectName+".prj")
-
-    hec.Project_Open(ras_file)
-    
-    # list of geometry data files
-    gf = ["Geom File=g"+str(i).zfill(2) for i in range(1,g+1)]
-
-    # list of unsteady flow data files
-    uf = ["Flow File=u"+str(i).zfill(2) for i in range(1,u+1)]
+    # list of geometry data files and unsteady flow data files
+    gn = list(range(1,g+1)) if np.isscalar(g) else list(g)
+    un = list(range(1,u+1)) if np.isscalar(u) else list(u)
 
     # change the format of the simulation datetime
     StartDT = pd.to_datetime(StartDateTime)
@@ -340,271 +801,61 @@ def Py2HecRas_1DU_Plan(g,u,StartDateTime,EndDateTime,CI="1HOUR",HI="1DAY",MI="1D
     EndDT = pd.to_datetime(EndDateTime)
     EndDT = EndDT.strftime('%d%b%Y,%H:%M')
 
-    # change the simulation interval
-    Computation_Interval=CI
-    Output_Interval=HI
-    Instantaneous_Interval=DI
-    Mapping_Interval=MI
-
-    # a list stores the template of an unsteady plan file
-
-    template_uf =  ['Plan Title=tempate_uf\n',
-                    'Program Version=5.07\n',
-                    'Short Identifier=unsteadyflow                                                              \n',
-                    'Simulation Date=01JAN2008,00:00,07JAN2008,00:00\n',
-                    'Geom File=g01\n',
-                    'Flow File=u01\n',
-                    'Subcritical Flow\n',
-                    'K Sum by GR= 0 \n',
-                    'Std Step Tol= .01 \n',
-                    'Critical Tol= .01 \n',
-                    'Num of Std Step Trials= 20 \n',
-                    'Max Error Tol= .3 \n',
-                    'Flow Tol Ratio= .001 \n',
-                    'Split Flow NTrial= 30 \n',
-                    'Split Flow Tol= .02 \n',
-                    'Split Flow Ratio= .02 \n',
-                    'Log Output Level= 0 \n',
-                    'Friction Slope Method= 1 \n',
-                    'Unsteady Friction Slope Method= 2 \n',
-                    'Unsteady Bridges Friction Slope Method= 1 \n',
-                    'Parabolic Critical Depth\n',
-                    'Global Vel Dist= 0 , 0 , 0 \n',
-                    'Global Log Level= 0 \n',
-                    'CheckData=True\n',
-                    'Encroach Param=-1 ,0,0, 0 \n',
-                    'Computation Interval=1HOUR\n',
-                    'Output Interval=1DAY\n',
-                    'Instantaneous Interval=1DAY\n',
-                    'Mapping Interval=1DAY\n',
-                    'Computation Time Step Use Courant=        0\n',
-                    'Computation Time Step Use Time Series=    0\n',
-                    'Computation Time Step Max Courant=\n',
-                    'Computation Time Step Min Courant=\n',
-                    'Computation Time Step Count To Double=0\n',
-                    'Computation Time Step Max Doubling=0\n',
-                    'Computation Time Step Max Halving=0\n',
-                    'Computation Time Step Residence Courant=0\n',
-                    'Run HTab=-1 \n',
-                    'Run UNet=-1 \n',
-                    'Run Sediment= 0 \n',
-                    'Run PostProcess= 0 \n',
-                    'Run WQNet= 0 \n',
-                    'Run RASMapper=-1 \n',
-                    'UNET Theta= 1 \n',
-                    'UNET Theta Warmup= 1 \n',
-                    'UNET ZTol= .02 \n',
-                    'UNET ZSATol= .02 \n', 'UNET QTol=\n',
-                    'UNET MxIter= 20 \n',
-                    'UNET Max Iter WO Improvement= 0 \n',
-                    'UNET MaxInSteps= 0 \n',
-                    'UNET DtIC= 0 \n',
-                    'UNET DtMin= 0 \n',
-                    'UNET MaxCRTS= 20 \n',
-                    'UNET WFStab= 2 \n',
-                    'UNET SFStab= 1 \n',
-                    'UNET WFX= 1 \n',
-                    'UNET SFX= 1 \n',
-                    'UNET 1D Methodology=Finite Difference\n',
-                    'UNET DSS MLevel= 4 \n', 'UNET Pardiso=0\n',
-                    'UNET DZMax Abort= 100 \n',
-                    'UNET Use Existing IB Tables=-1 \n',
-                    'UNET Froude Reduction=False\n',
-                    'UNET Froude Limit= .8 \n',
-                    'UNET Froude Power= 4 \n',
-                    'UNET D1 Cores= 0 \n',
-                    'UNET D2 Coriolis=0\n',
-                    'UNET D2 Cores= 0 \n',
-                    'UNET D2 Theta= 1 \n',
-                    'UNET D2 Theta Warmup= 1 \n',
-                    'UNET D2 Z Tol= .01 \n',
-                    'UNET D2 Volume Tol= .01 \n',
-                    'UNET D2 Max Iterations= 20 \n',
-                    'UNET D2 Equation= 0 \n',
-                    'UNET D2 TotalICTime=\n',
-                    'UNET D2 RampUpFraction=.1\n',
-                    'UNET D2 TimeSlices= 1 \n',
-                    'UNET D2 Eddy Viscosity=\n',
-                    'UNET D2 BCVolumeCheck=0\n',
-                    'UNET D2 Latitude=\n',
-                    'UNET D1D2 MaxIter= 0 \n',
-                    'UNET D1D2 ZTol=.01\n',
-                    'UNET D1D2 QTol=.1\n',
-                    'UNET D1D2 MinQTol=1\n',
-                    'DSS File=dss\n',
-                    'Write IC File= 0 \n',
-                    'Write IC File at Fixed DateTime=0\n',
-                    'IC Time=,,\n',
-                    'Write IC File Reoccurance=\n',
-                    'Write IC File at Sim End=0\n',
-                    'Echo Input=False\n',
-                    'Echo Parameters=False\n',
-                    'Echo Output=False\n',
-                    'Write Detailed= 0 \n',
-                    'HDF Write Warmup=0\n',
-                    'HDF Write Time Slices=0\n',
-                    'HDF Flush=0\n',
-                    'HDF Face Node Velocities=0\n',
-                    'HDF Compression= 1 \n',
-                    'HDF Chunk Size= 1 \n',
-                    'HDF Spatial Parts= 1 \n',
-                    'HDF Use Max Rows=0\n',
-                    'HDF Fixed Rows= 1 \n',
-                    'Calibration Method= 0 \n',
-                    'Calibration Iterations= 20 \n',
-                    'Calibration Max Change=.05\n',
-                    'Calibration Tolerance=.2\n',
-                    'Calibration Maximum=1.5\n',
-                    'Calibration Minimum=.5\n',
-                    'Calibration Optimization Method= 1 \n',
-                    'Calibration Window=,,,\n',
-                    'WQ AD Non Conservative\n',
-                    'WQ ULTIMATE=-1\n',
-                    'WQ Max Comp Step=1HOUR\n',
-                    'WQ Output Interval=15MIN\n',
-                    'WQ Output Selected Increments= 0 \n',
-                    'WQ Output face flow=0\n',
-                    'WQ Output face velocity=0\n',
-                    'WQ Output face area=0\n',
-                    'WQ Output face dispersion=0\n',
-                    'WQ Output cell volume=0\n',
-                    'WQ Output cell surface area=0\n',
-                    'WQ Output cell continuity=0\n',
-                    'WQ Output cumulative cell continuity=0\n',
-                    'WQ Output face conc=0\n',
-                    'WQ Output face dconc_dx=0\n',
-                    'WQ Output face courant=0\n',
-                    'WQ Output face peclet=0\n',
-                    'WQ Output face adv mass=0\n',
-                    'WQ Output face disp mass=0\n',
-                    'WQ Output cell mass=0\n',
-                    'WQ Output cell source sink temp=0\n',
-                    'WQ Output nsm pathways=0\n',
-                    'WQ Output nsm derived pathways=0\n',
-                    'WQ Output MaxMinRange=-1\n',
-                    'WQ Daily Max Min Mean=-1\n',
-                    'WQ Daily Range=0\n',
-                    'WQ Daily Time=0\n',
-                    'WQ Create Restart=0\n',
-                    'WQ Fixed Restart=0\n',
-                    'WQ Restart Simtime=\n',
-                    'WQ Restart Date=\n',
-                    'WQ Restart Hour=\n',
-                    'WQ System Summary=0\n',
-                    'WQ Write To DSS=0\n',
-                    'WQ Use Fixed Temperature=0\n',
-                    'WQ Fixed Temperature=\n',
-                    'Sorting and Armoring Iterations= 10 \n',
-                    'XS Update Threshold= .02 \n',
-                    'Bed Roughness Predictor= 0 \n',
-                    'Hydraulics Update Threshold= .02 \n',
-                    'Energy Slope Method= 1 \n',
-                    'Volume Change Method= 1 \n',
-                    'Sediment Retention Method= 0 \n',
-                    'XS Weighting Method= 0 \n',
-                    'Number of US Weighted Cross Sections= 1 \n',
-                    'Number of DS Weighted Cross Sections= 1 \n',
-                    'Upstream XS Weight=0\n', 'Main XS Weight=1\n',
-                    'Downstream XS Weight=0\n',
-                    "Number of DS XS's Weighted with US Boundary= 1 \n",
-                    'Upstream Boundary Weight= 1 \n',
-                    'Weight of XSs Associated with US Boundary= 0 \n',
-                    "Number of US XS's Weighted with DS Boundary= 1 \n",
-                    'Downstream Boundary Weight= .5 \n',
-                    'Weight of XSs Associated with DS Boundary= .5 \n',
-                    'Percentile Method= 0 \n',
-                    'Sediment Output Level= 3 \n',
-                    'Mass or Volume Output= 0 \n',
-                    'Output Increment Type= 1 \n',
-                    'Profile and TS Output Increment= 1 \n',
-                    'XS Output Flag= 0 \n',
-                    'XS Output Increment= 10 \n',
-                    'Write Gradation File= 0 \n',
-                    'Read Gradation Hotstart= 0 \n',
-                    'Gradation File Name=\n',
-                    'Write HDF5 File= 1 \n',
-                    'Write Binary Output= 1 \n',
-                    'Write DSS Sediment File= 0 \n',
-                    'SV Curve= 0 \n',
-                    'Specific Gage Flag= 0 \n']
+    # the template of an unsteady plan file with the simulation datetime and intervals
+    template = PlanFile.Read(Template) if Template else PlanFile(TEMPLATE_1DU_PLAN)
+    template.Update({"Simulation Date": StartDT+','+EndDT,
+                     "Computation Interval": CI,
+                     "Output Interval": HI,
+                     "Instantaneous Interval": DI,
+                     "Mapping Interval": MI})
 
     # New plan files are different combinations of geometry data files and unsteady flow data files
-    pn = hec.Plan_Names()[0]
-    ProjectName=ProjectName
+    prj = ProjectFile.Read(ProjectName+".prj")
+    pn = prj.LastNumber("p")
+    _Check_Numbers('p',pn+1,len(gn)*len(un))
+    PlanFiles = []
 
-    for i in range(g):
-        for j in range(u):
+    for i in gn:
+        for j in un:
 
             pn += 1
-            
-            # read the initial HEC-RAS plan file
-            f_old = template_uf
+
+            plan = template.Copy()
+            plan.Update({"Plan Title": "Plan "+str(pn).zfill(2),
+                         "Short Identifier": "g"+str(i).zfill(2)+"u"+str(j).zfill(2),
+                         "Geom File": "g"+str(i).zfill(2),
+                         "Flow File": "u"+str(j).zfill(2)})
 
             # write the new plan file
-            f_new = open(ProjectName+'.p'+str(pn).zfill(2),'w')
-
-            for line in f_old:
-                if "Plan Title=" in line:
-                    # replace the Plan Title
-                    #line = line.replace("Plan Title="+filename,"Plan Title=g"+str(i+1).zfill(2)+"u"+str(j+1).zfill(2))
-                    #line = "Plan Title=g"+str(i+1).zfill(2)+"u"+str(j+1).zfill(2)+"\n"
-                    line = "Plan Title=Plan "+str(pn).zfill(2)+"\n"
-                    
-                elif "Short Identifier=" in line:
-                    # replace the Short Identifier
-                    line = "Short Identifier=g"+str(i+1).zfill(2)+"u"+str(j+1).zfill(2)+"\n"
-
-                elif "Simulation Date=" in line:
-                    # replace the simulation datetime
-                    line = "Simulation Date="+str(StartDT)+','+str(EndDT)+"\n"
-
-                elif "Geom File=" in line:
-                    # replace the Geom File
-                    line = line.replace("Geom File=g01",gf[i])
-                    
-                elif "Flow File=" in line:
-                    # replace the Flow File
-                    line = line.replace("Flow File=u01",uf[j])
-
-                elif "Computation Interval=" in line:
-                    # replace the Computation Interval
-                    line = "Computation Interval="+Computation_Interval+"\n"
-
-                elif "Output Interval=" in line:
-                    # replace the Output Interval
-                    line = "Output Interval="+Output_Interval+"\n"
-
-                elif "Instantaneous Interval=" in line:
-                    # replace the Instantaneous Interval
-                    line = "Instantaneous Interval="+Instantaneous_Interval+"\n"
-
-                elif "Mapping Interval=" in line:
-                    # replace the Mapping Interval
-                    line = "Mapping Interval="+Mapping_Interval+"\n"
-                    
-                f_new.write(line)
-
-            f_new.close()
-    
-    # modify the original project file
-    Py2HecRas_1DU_Project(u=u,g=0,p=pn,ProjectName)
-    
-    # close HEC-RAS Project
-    hec.Project_Close()
-    hec.QuitRas()
-    
-    # delete HEC-RAS controller
-    del hec
-      
+            PlanFiles.append(ProjectName+'.p'+str(pn).zfill(2))
+            plan.Write(PlanFiles[-1])
+            prj.Register("p",pn)
+
+    # modify the original project file once, registering the plans and the files they use
+    for i in gn:
+        prj.Register("g",i)
+    for j in un:
+        prj.Register("u",j)
+    prj.Write()
+
     print("HEC-RAS 1D unsteady flow plan file "+ProjectName+" is done!")
 
+    return PlanFiles
 
 ## a function to run a 1D unsteady flow analysis and extract the results
 
-def Py2HecRas_1DU_Run(ProjectName):
+def Py2HecRas_1DU_Run(ProjectName,output_format="hdf",cache_dir=None,ras_backend=None):
     """This function takes a ProjectName of HEC-RAS 1D unsteady flow analysis as input.
        Run the HEC-RAS model, and then extract the base results of all the cross sections,
-       which are saved as CSV files in the results folder - '1D_Unsteady_Results'."""
+       which are saved in the results folder - '1D_Unsteady_Results'; raises a RuntimeError
+       if the run fails.
+       output_format is "hdf" (one compressed HDF5 file, see Read_1DU_Results) or "csv"
+       (one CSV file per variable)
+       cache_dir is the folder of the run cache (optional): if the plan, geometry and
+       unsteady flow files are identical to a cached run, the plan HDF file is restored
+       instead of computing the plan again, and the results are extracted from it
+       ras_backend is the solver backend (default a warm HEC-RAS controller session, see
+       backend.session; e.g. backend.FakeBackend() runs the pipeline without HEC-RAS)"""
 
     # function to create a folder to store the results if it does not exist
 
@@ -612,167 +863,259 @@ def Py2HecRas_1DU_Run(ProjectName):
         if os.path.exists(Folder) == False:
             os.mkdir(Folder)
 
-    # Initiate HEC-RAS API
-    hec=Dispatch("RAS507.HECRASController")
-    #hec_geo=Dispatch("RAS507.HECRASGeometry")
-
     ProjectName = ProjectName
 
     ras_file = os.path.join(os.getcwd(),ProjectName+".prj")
 
-    hec.ShowRas()
-
-    hec.Project_Open(ras_file)
-
-    # obtain the number and name of plan files
-    #PlanNo=hec.Plan_Names()[0]
-    PlanNames=hec.Plan_Names()[1]
-
-    #hec.Plan_SetCurrent(PlanNames[i])
-    hec.Plan_SetCurrent(PlanNames[0])
-
     ### extract resilts from 1D HEC-RAS unsteady flow analysis
 
     Folder1 = './1D_Unsteady_Results/'
     ResultsFolder(Folder1)
 
-    Msg1,Msg2,Msg3,Msg4 = hec.Compute_CurrentPlan(None,None,True)
-
-    # extract results from HDF file(e.g.,PlanName.p01.hdf)
-    # read the datasets and groups in the HDF5 file
-    hdf = h5py.File(hec.CurrentPlanFile()+'.hdf', 'r')
-
-    # extract WSE
-    WSE_all = np.array(hdf.get('Results')
-                       .get('Unsteady')
-                       .get('Output')
-                       .get('Output Blocks')
-                       .get('Base Output')
-                       .get('Unsteady Time Series')
-                       .get('Cross Sections')
-                       .get('Water Surface'))
-
-    WSE_all = np.transpose(WSE_all)
-
-    # extract flow
-    flow_all = np.array(hdf.get('Results')
-                        .get('Unsteady')
-                        .get('Output')
-                        .get('Output Blocks')
-                        .get('Base Output')
-                        .get('Unsteady Time Series')
-                        .get('Cross Sections')
-                        .get('Flow'))
-
-    flow_all = np.transpose(flow_all)
-
-    # extract average velocity of flow in main channel
-    VC_all = np.array(hdf.get('Results')
-                        .get('Unsteady')
-                        .get('Output')
-                        .get('Output Blocks')
-                        .get('Base Output')
-                        .get('Unsteady Time Series')
-                        .get('Cross Sections')
-                        .get('Velocity Channel'))
-
-    VC_all = np.transpose(VC_all)
-
-    # extract average velocity of flow in total cross section
-    VT_all = np.array(hdf.get('Results')
-                        .get('Unsteady')
-                        .get('Output')
-                        .get('Output Blocks')
-                        .get('Base Output')
-                        .get('Unsteady Time Series')
-                        .get('Cross Sections')
-                        .get('Velocity Total'))
-
-    VT_all = np.transpose(VT_all)
-
-    DateTime = np.array(hdf.get('Results')
-                        .get('Unsteady')
-                        .get('Output')
-                        .get('Output Blocks')
-                        .get('Base Output')
-                        .get('Unsteady Time Series')
-                        .get('Time Date Stamp'))
-
-    DateTime = [str(DateTime[i]).split("'")[1] for i in range(len(DateTime))]
-    DateTime = pd.to_datetime(DateTime)
-    DateTime = DateTime.strftime('%d-%m-%Y %H:%M:%S')
-    DateTime = list(DateTime)
-    
-    # extract the information of all the cross sections
-
-    CS_all = np.array(hdf.get('Results')
-                      .get('Unsteady')
-                      .get('Output')
-                      .get('Output Blocks')
-                      .get('Base Output')
-                      .get('Unsteady Time Series')
-                      .get('Cross Sections')
-                      .get('Cross Section Only'))
-
-    CS_all = [str(CS_all[i]).split("'")[1] for i in range(len(CS_all))]
+    ResultsFile = Folder1 + "Results of " + ProjectName + ".h5"
 
-    CS_all = np.array([CS_all[i].split() for i in range(len(CS_all))])
+    # HEC-RAS session (kept open with the project between calls)
+    with session(ras_backend) as ras:
 
-    Xs_ID = CS_all[:,2]
+        ras.open(ras_file)
 
-    River = CS_all[:,0]
+        # obtain the name of plan files
+        PlanNames=ras.plan_names()
 
-    Reach = CS_all[:,1]
+        ras.set_current_plan(PlanNames[0])
 
-    # organize the dataframe for output
+        PlanFile = ras.current_plan_file()
 
-    WSE_all = np.c_[River,Reach,WSE_all]
+        # only the plan HDF file is cached, the results of either format are extracted from it
+        Outputs = {'plan.hdf': PlanFile+'.hdf'}
 
-    flow_all = np.c_[River,Reach,flow_all]
+        Restored = False
+        if cache_dir:
+            Key = utils.run_cache_key(PlanFile,ras.version)
+            Restored = utils.run_cache_restore(cache_dir,Key,Outputs)
 
-    VC_all = np.c_[River,Reach,VC_all]
+        if Restored:
+            print("HEC-RAS 1D unsteady flow run of "+ProjectName+" is restored from the run cache!")
+        else:
+            # never extract the results of an earlier run
+            if os.path.exists(PlanFile+'.hdf'):
+                os.remove(PlanFile+'.hdf')
+            if not ras.compute_current_plan() or not os.path.exists(PlanFile+'.hdf'):
+                raise RuntimeError("HEC-RAS 1D unsteady flow run of "+ProjectName+" failed")
 
-    VT_all = np.c_[River,Reach,VT_all]
-
-    DateTime = ['River','Reach']+DateTime
-
-    # create dataframes to store the WSE (stage),flow, and velocity of all the cross sections
-
-    WSE = pd.DataFrame(WSE_all,
-                       index=Xs_ID,
-                       columns=DateTime)
-    WSE.index.name = 'Xs_ID'
-
-    flow = pd.DataFrame(flow_all,
-                       index=Xs_ID,
-                       columns=DateTime)
-    flow.index.name = 'Xs_ID'
+    # extract results from HDF file(e.g.,PlanName.p01.hdf)
+    with PlanResults(PlanFile+'.hdf') as plan:
+
+        # extract WSE, flow, average velocity of flow in main channel and in total cross section
+        WSE_all = np.transpose(plan.WSE[:])
+        flow_all = np.transpose(plan.Flow[:])
+        VC_all = np.transpose(plan.VC[:])
+        VT_all = np.transpose(plan.VT[:])
+
+        Times = plan.Times()
+
+        # extract the information of all the cross sections
+        River, Reach, Xs_ID = plan.CrossSections()
+
+    # save WSE, flow and velocities of all the CS in the "1D_Unsteady_Results" folder
+    results = {'Water Surface': WSE_all,
+               'Flow': flow_all,
+               'Velocity Channel': VC_all,
+               'Velocity Total': VT_all}
+
+    if output_format == "csv":
+        file_names = {'Water Surface': "WSE of ",
+                      'Flow': "Flow of ",
+                      'Velocity Channel': "Channel velocity of ",
+                      'Velocity Total': "Cross section velocity of "}
+        for var in results:
+            # keep the results as numbers, River and Reach are added as separate columns
+            df = pd.DataFrame(results[var], index=Xs_ID, columns=list(Times.strftime('%d-%m-%Y %H:%M:%S')))
+            df.index.name = 'Xs_ID'
+            df.insert(0, 'Reach', Reach)
+            df.insert(0, 'River', River)
+            df.to_csv(Folder1 + file_names[var] + ProjectName + ".csv")
+    else:
+        Write_1DU_Results(ResultsFile, River, Reach, Xs_ID, Times, results)
 
-    VC = pd.DataFrame(VC_all,
-                      index=Xs_ID,
-                      columns=DateTime)
-    VC.index.name = 'Xs_ID'
+    if cache_dir and not Restored:
+        utils.run_cache_store(cache_dir,Key,Outputs)
 
-    VT = pd.DataFrame(VT_all,
-                      index=Xs_ID,
-                      columns=DateTime)
-    VT.index.name = 'Xs_ID'
-    
+    print("HEC-RAS 1D unsteady flow results for "+ProjectName+" are done!")
 
-    # save WSE and flow of all the CS as CSV in the "1D_Unsteady_Results" folder
-    WSE.to_csv(Folder1 + "WSE of "+ ProjectName +".csv")
-    flow.to_csv(Folder1 + "Flow of "+ ProjectName +".csv")
-    VC.to_csv(Folder1 + "Channel velocity of "+ ProjectName +".csv")
-    VT.to_csv(Folder1 + "Cross section velocity of "+ ProjectName +".csv")
 
-    # close HEC-RAS Project and quit
-    hec.Project_Close()
-    hec.QuitRas()
+## a class to read the 1D unsteady results of a plan HDF file
 
-    # delete HEC-RAS controller
-    del hec
+class PlanResults:
+    """PlanResults opens a plan HDF file (e.g.,ProjectName.p01.hdf) once and gives lazy access
+       to the unsteady time series (times x cross sections) of all the cross sections.
+       A dataset is only read when it is indexed, e.g. PlanResults(PlanFile).WSE[:,0]
+       reads the WSE of the first cross section only.
+       Use it in a with statement or call close() when done.
+       """
 
-    print("HEC-RAS 1D unsteady flow results for "+ProjectName+" are done!")
+    TS_PATH = 'Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series'
+
+    def __init__(self,PlanFile):
+        self.PlanFile = PlanFile
+        self.hdf = h5py.File(PlanFile, 'r')
+        # resolve the groups of the time series once
+        self.ts = self.hdf[self.TS_PATH]
+        self.cs = self.ts['Cross Sections']
+        self._times = None
+        self._cross_sections = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def close(self):
+        self.hdf.close()
+
+    def __getitem__(self,name):
+        # any dataset of the cross sections, e.g. plan['Water Surface'] (h5py dataset, read lazily)
+        return self.cs[name]
+
+    def __contains__(self,name):
+        return name in self.cs
+
+    def Variables(self):
+        """names of all the cross section time series in the plan file"""
+        return [name for name, item in self.cs.items()
+                if isinstance(item, h5py.Dataset) and item.ndim == 2]
+
+    @property
+    def WSE(self):
+        return self.cs['Water Surface']
+
+    @property
+    def Flow(self):
+        return self.cs['Flow']
+
+    @property
+    def VC(self):
+        return self.cs['Velocity Channel']
+
+    @property
+    def VT(self):
+        return self.cs['Velocity Total']
+
+    def TimeStamps(self):
+        """Time Date Stamp of the outputs as strings"""
+        return np.char.decode(self.ts['Time Date Stamp'][:])
+
+    def Times(self):
+        """Time Date Stamp of the outputs as a DatetimeIndex (24:00 is 00:00 of the next day)"""
+        if self._times is None:
+            self._times = utils.read_time_stamps(self.hdf, self.ts['Time Date Stamp'].name)
+        return self._times
+
+    def CrossSections(self):
+        """River, Reach and river station (Xs_ID) of each cross section"""
+        if self._cross_sections is None:
+            # River and Reach are fixed-width fields, and may contain spaces
+            self._cross_sections = utils.split_cross_section_names(self.cs['Cross Section Only'][:])
+        return self._cross_sections
+
+    def Query(self,variable,start=None,end=None,River=None,Reach=None,Xs_ID=None):
+        """variable is the name of a cross section time series, e.g. 'Water Surface'
+           start and end are the first and last datetime of the time window (None for no limit)
+           River, Reach and Xs_ID are a name/river station or a list of them (None for all)
+           returns a DataFrame (times x selected cross sections); only the time window and
+           the selected cross sections are read from the file
+           """
+        # time window as a range of rows
+        times = self.Times()
+        t0 = times.searchsorted(pd.Timestamp(start), side='left') if start is not None else 0
+        t1 = times.searchsorted(pd.Timestamp(end), side='right') if end is not None else len(times)
+        t1 = max(t0, t1)
+
+        # selected cross sections as a list of columns
+        River_all, Reach_all, Xs_all = self.CrossSections()
+        mask = np.ones(len(Xs_all), dtype=bool)
+        for values, names in ((River, River_all), (Reach, Reach_all), (Xs_ID, Xs_all)):
+            if values is not None:
+                values = [values] if np.isscalar(values) else values
+                mask &= np.isin(names, [str(v) for v in values])
+        cols = np.flatnonzero(mask)
+
+        # read the hyperslab (one contiguous block if the columns are adjacent)
+        dataset = self.cs[variable]
+        if len(cols) == 0:
+            data = np.empty((t1-t0, 0), dtype=dataset.dtype)
+        elif cols[-1]-cols[0]+1 == len(cols):
+            data = dataset[t0:t1, cols[0]:cols[-1]+1]
+        else:
+            data = dataset[t0:t1, cols]
+
+        columns = pd.MultiIndex.from_arrays([River_all[cols], Reach_all[cols], Xs_all[cols]],
+                                            names=['River','Reach','Xs_ID'])
+        return pd.DataFrame(data, index=times[t0:t1], columns=columns)
+
+    def Statistics(self,variable,thresholds=None,chunk_size=utils.CHUNK_SIZE):
+        """variable is the name of a cross section time series, e.g. 'Water Surface'
+           thresholds is a list of thresholds to compute the duration (hours) above
+           returns a DataFrame of the maximum, time of maximum, minimum and durations above
+           the thresholds of each cross section, computed chunk_size times at a time
+           """
+        stats = utils.unsteady_statistics(self.cs[variable], self.Times(), thresholds, chunk_size)
+        stats.index = pd.MultiIndex.from_arrays(list(self.CrossSections()),
+                                                names=['River','Reach','Xs_ID'])
+        return stats
+
+## a function to write the 1D unsteady results to a compressed HDF5 file
+
+def Write_1DU_Results(FileName,River,Reach,Xs_ID,Times,results):
+    """FileName is the path of the HDF5 file to write
+       River, Reach and Xs_ID are the river, reach and river station of each cross section
+       Times is the DatetimeIndex (or list of datetimes) of the outputs, stored as int64
+       nanoseconds since 1970-01-01
+       results is a dict of {variable name: float array (cross sections x times)}
+       """
+    str_dt = h5py.string_dtype()
+
+    with h5py.File(FileName, 'w') as f:
+        # index metadata of the result arrays
+        f.create_dataset('River', data=np.asarray(River, dtype=object), dtype=str_dt)
+        f.create_dataset('Reach', data=np.asarray(Reach, dtype=object), dtype=str_dt)
+        f.create_dataset('Xs_ID', data=np.asarray(Xs_ID, dtype=object), dtype=str_dt)
+        Time = f.create_dataset('Time', data=np.asarray(pd.DatetimeIndex(Times), dtype='datetime64[ns]').view(np.int64))
+        Time.attrs['units'] = 'nanoseconds since 1970-01-01 00:00:00'
+
+        # results, one float dataset per variable
+        for var, values in results.items():
+            f.create_dataset(var, data=np.asarray(values, dtype=np.float32),
+                             compression='gzip', shuffle=True)
+
+## a function to read the 1D unsteady results written by Py2HecRas_1DU_Run
+
+def Read_1DU_Results(FileName,variables=None):
+    """FileName is the path of the HDF5 file written by Py2HecRas_1DU_Run
+       variables is a list of the variables to read (default: all of them)
+       returns a dict of {variable name: DataFrame (cross sections x times)}
+       indexed by River, Reach and Xs_ID, with a DatetimeIndex of the output times as columns
+       """
+    with h5py.File(FileName, 'r') as f:
+        index = pd.MultiIndex.from_arrays([f['River'].asstr()[:],
+                                           f['Reach'].asstr()[:],
+                                           f['Xs_ID'].asstr()[:]],
+                                          names=['River','Reach','Xs_ID'])
+        if f['Time'].dtype.kind in 'iu':
+            columns = pd.to_datetime(f['Time'][:], unit='ns')
+        else:
+            # files written with the times as text
+            columns = pd.to_datetime(f['Time'].asstr()[:], format='%d-%m-%Y %H:%M:%S')
+
+        if variables is None:
+            variables = [var for var in f if var not in ('River','Reach','Xs_ID','Time')]
+
+        results = {}
+        for var in variables:
+            results[var] = pd.DataFrame(f[var][:], index=index, columns=columns)
+
+    return results
 
 
 # the following condition checks whether we are running as a script, in which case run the test code
@@ -5,21 +5,40 @@ Created on Mon Mar 15 14:26 2021
 Provides functions for automating input/output HEC-RAS 2D unsteady state models
 """
 
+import os
 import math
+import hashlib
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 import h5py
 import random
 import numpy as np
 import pandas as pd
 import utils
 import matplotlib.pyplot as plt
-from shapely.geometry import MultiPoint, Point, Polygon, mapping
+from matplotlib.path import Path
+from shapely.geometry import MultiPoint, Point, mapping
 import fiona
 from fiona import collection
 from fiona.crs import from_epsg
+from scipy import sparse
+from scipy.spatial import cKDTree
 
-def get_wse(input_plan_file, input_geometry_file, sample_points, coordinate_system):
+# maximum total size (bytes) of the IDW weight cache folder
+IDW_CACHE_SIZE = 512*1024**2
+# number of timesteps read from the HDF file at a time
+WSE_CHUNK_SIZE = 1000
+
+# HDF paths of the 2D flow area geometry and unsteady results
+GEOMETRY_2D_PATH = '/Geometry/2D Flow Areas/'
+RESULTS_PATH = '/Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/'
+RESULTS_2D_PATH = RESULTS_PATH + '2D Flow Areas/'
+
+def get_wse(input_plan_file, input_geometry_file, sample_points, coordinate_system, cache_dir=None,
+            output_csv='data/wse_point.csv', output_shp='data/random_points.shp'):
     """
-    extracts water surface elevation (wse) data from geometry file based on some sample points within 2D interior area 
+    extracts water surface elevation (wse) data from geometry file based on some sample points within the 2D flow areas 
     
     Parameters
     ----------
@@ -27,73 +46,196 @@ def get_wse(input_plan_file, input_geometry_file, sample_points, coordinate_syst
     input_geometry_file: string(filepath of the geometry file)
     sample_points: list(coordinate of sample points)
     coordinate_system: string(from_epsg(...))
+    cache_dir: string(folder to cache the IDW weights in, optional)
+    output_csv: string(filepath of the output csv file)
+    output_shp: string(filepath of the output point shapefile)
         
     Returns
     -------
-    data/random_points.shp : a csv file with wse data of given points
-    """
-    # read plan hdf file 
-    f = h5py.File(input_plan_file, 'r')
-    # extract the data of cells center coordinate
-    c = f['/Geometry/2D Flow Areas/2D Interior Area/Cells Center Coordinate']
-    c = np.array(c)
-    # store x-coordinate and y-coordinate data in saparate lists
-    x, y = c.T
-
-    # extract the data of water surface elevation
-    wse = f['/Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/2D Flow Areas/2D Interior Area/Water Surface']
-    wse = np.array(wse)
-
-    # extract the data of time date stamp
-    td = f['/Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/Time Date Stamp']
-    # trsnform data type from bytestring to string
-    td = np.char.decode(td)
-
-    # read geometry hdf file
-    f1 = h5py.File(input_geometry_file, 'r')
-    # extract the perimeter data of the 2D interior area
-    perimeter = f1['/Geometry/2D Flow Areas/2D Interior Area/Perimeter']
-    perimeter = np.array(perimeter)
-    # create the boundary polygon
-    perimeter = Polygon(perimeter)
-
-    pt_valid = []
-    for point in sample_points:
-        point = Point(point)
-        if not perimeter.contains(point): # check if the point is within the 2D interior region
-            print('The point ('+ str(point.x)+','+ str(point.y) + ') is out of the 2D interior region')
-            continue
-        else:
-            pt_valid.append([point.x, point.y])
-    # print all valid points 
-    print('Coordinate of valid points:')
-    print(pt_valid)
+    output_csv : a csv file with wse data of given points
+    output_shp : a shapefile of the given points within the 2D flow areas
+    """
+    td, elev, area = extract_wse(input_plan_file, input_geometry_file, sample_points, cache_dir=cache_dir)
+
+    # only keep the points within one of the 2D flow areas
+    pt_valid = np.asarray(sample_points, dtype=float).reshape(-1, 2)[area >= 0]
+    elev = elev[:, area >= 0]
+    if (area < 0).any():
+        print(str((area < 0).sum()) + ' of ' + str(len(area)) + ' points are out of the 2D flow areas')
 
     # Create the random-point shapefile
-    utils.create_shp(pt_valid, 'data/random_points.shp', coordinate_system) #from_epsg(102673)
-
-    # Set the parameters for IDW method
-    r = 150 # block radius
-    p = 2 # p-value
-    for k in pt_valid:
-        xz = k[0]
-        yz = k[1]
-        elev = []
-        # predict elevation data
-        for i in range(len(wse)):
-            z = wse[i]
-            elev.append(utils.idw_rblock(xz,yz,r,p,x,y,z))
-        elev = np.array(elev) # store the predicted data of wse in a list
-        # combine the wse data of the point and time date stamp data
-        td = np.column_stack((td, elev))
+    create_shp(pt_valid.tolist(), output_shp, coordinate_system) #from_epsg(102673)
 
     # store the data in a pandas dataframe
-    df = pd.DataFrame(td)
-    df[1] = pd.to_numeric(df[1])
+    df = pd.DataFrame(elev, columns=range(1, len(pt_valid)+1))
+    df.insert(0, "Time", td) # the first column is the time date stamp
     # print(df.head())
     # save to csv file
-    df.rename(columns={ df.columns[0]: "Time" }, inplace = True) # rename the first column as 'Time'
-    df.to_csv('data/wse_point.csv', index=False)
+    df.to_csv(output_csv, index=False)
+
+def get_wse_batch(input_plan_files, input_geometry_file, sample_points, output_file, r=150, p=2, cache_dir=None, processes=None):
+    """
+    extracts the wse time series of sample points from many plan files sharing a geometry, 
+    running the plans in a process pool. On Windows, call it under if __name__ == '__main__':
+    
+    Parameters
+    ----------
+    input_plan_files : list(filepaths of the plan files)
+    input_geometry_file: string(filepath of the geometry file)
+    sample_points: list(coordinate of sample points)
+    output_file: string(filepath of the output HDF5 file)
+    r: search radius of IDW
+    p: power value of IDW
+    cache_dir: string(folder to cache the IDW weights in, optional)
+    processes: number of worker processes (default: number of cores)
+        
+    Returns
+    -------
+    wse : array (timesteps x sample points x plans) of wse, NaN for points out of the 2D flow areas 
+          and for timesteps beyond the end of shorter plans
+    output_file : an HDF5 file with datasets WSE (time x point x plan), Time (time x plan), 
+                  Points (point x 2), Area (point) and Plans (plan)
+    """
+    input_plan_files = list(input_plan_files)
+    points = np.asarray(sample_points, dtype=float).reshape(-1, 2)
+    n = len(input_plan_files)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(extract_wse, input_plan_files, [input_geometry_file]*n, [points]*n,
+                                    [r]*n, [p]*n, [cache_dir]*n))
+
+    # gather the plans into one (time x point x plan) array
+    n_time = max([len(td) for td, elev, area in results], default=0)
+    wse = np.full((n_time, len(points), n), np.nan)
+    td_all = np.full((n_time, n), np.datetime64('NaT'), dtype='datetime64[s]')
+    for k, (td, elev, area) in enumerate(results):
+        wse[:len(td), :, k] = elev
+        td_all[:len(td), k] = td.values
+    area = results[0][2] if results else np.full(len(points), -1)
+
+    with h5py.File(output_file, 'w') as out:
+        dset = out.create_dataset('WSE', data=wse, compression='gzip', shuffle=True)
+        for i, label in enumerate(['time', 'point', 'plan']):
+            dset.dims[i].label = label
+        out.create_dataset('Time', data=np.datetime_as_string(td_all).astype('S'))
+        out.create_dataset('Points', data=points)
+        out.create_dataset('Area', data=area)
+        out.create_dataset('Plans', data=np.array([str(f) for f in input_plan_files], dtype='S'))
+        out.attrs['r'] = r
+        out.attrs['p'] = p
+    return wse
+
+def extract_wse(input_plan_file, input_geometry_file, sample_points, r=150, p=2, cache_dir=None, chunk_size=WSE_CHUNK_SIZE):
+    """
+    interpolates the water surface elevation (wse) time series of sample points in any 2D flow area
+    
+    Parameters
+    ----------
+    input_plan_file : string(filepath of the plan file)
+    input_geometry_file: string(filepath of the geometry file)
+    sample_points: list(coordinate of sample points)
+    r: search radius of IDW
+    p: power value of IDW
+    cache_dir: string(folder to cache the IDW weights in, optional)
+    chunk_size: number of timesteps read at a time
+        
+    Returns
+    -------
+    td : DatetimeIndex of the time date stamps
+    elev : array (timesteps x sample points) of wse, NaN for points out of the 2D flow areas
+    area : array of the index of the 2D flow area (in get_2d_flow_areas order) of each point, -1 if out of all areas
+    """
+    points = np.asarray(sample_points, dtype=float).reshape(-1, 2)
+    areas = get_2d_flow_areas(input_geometry_file)
+    area = locate_points(points, list(areas.values()))
+
+    with h5py.File(input_plan_file, 'r') as f:
+        # extract the data of time date stamp as datetimes
+        td = utils.read_time_stamps(f, RESULTS_PATH + 'Time Date Stamp')
+        elev = np.full((len(td), len(points)), np.nan)
+
+        for k, (name, perimeter) in enumerate(areas.items()):
+            idx = np.flatnonzero(area == k)
+            if len(idx) == 0:
+                continue
+            # extract the data of cells center coordinate
+            x, y = np.array(f[GEOMETRY_2D_PATH + name + '/Cells Center Coordinate']).T
+            # build the IDW weights once (or load them from the cache) and apply them to all the timesteps at once
+            if cache_dir:
+                weights = idw_weights_cached(points[idx, 0], points[idx, 1], r, p, x, y, perimeter, cache_dir)
+            else:
+                weights = idw_weights(points[idx, 0], points[idx, 1], r, p, x, y)
+            # water surface elevation data, only the cells needed for the interpolation are read
+            wse = f[RESULTS_2D_PATH + name + '/Water Surface']
+            elev[:, idx] = idw_apply_hdf(weights, wse, chunk_size)
+
+    return td, elev, area
+
+def get_2d_statistics(input_plan_file, variable='Water Surface', thresholds=None, chunk_size=WSE_CHUNK_SIZE):
+    """
+    computes the maximum, time of maximum, minimum and durations above thresholds of a 2D time series 
+    for every cell of every 2D flow area, reading chunk_size timesteps at a time
+    
+    Parameters
+    ----------
+    input_plan_file : string(filepath of the plan file)
+    variable: string(name of the 2D time series, e.g. 'Water Surface')
+    thresholds: list of thresholds to compute the duration (hours) above (optional)
+    chunk_size: number of timesteps read at a time
+        
+    Returns
+    -------
+    stats : dict of {name of the 2D flow area: DataFrame of statistics (one row per cell)}
+    """
+    stats = {}
+    with h5py.File(input_plan_file, 'r') as f:
+        times = utils.read_time_stamps(f, RESULTS_PATH + 'Time Date Stamp')
+        for name, item in f[RESULTS_2D_PATH].items():
+            if isinstance(item, h5py.Group) and variable in item:
+                stats[name] = utils.unsteady_statistics(item[variable], times, thresholds, chunk_size)
+                stats[name].index.name = 'Cell'
+    return stats
+
+def get_2d_flow_areas(input_geometry_file):
+    """
+    lists the 2D flow areas of a geometry file
+    
+    Parameters
+    ----------
+    input_geometry_file: string(filepath of the geometry file)
+        
+    Returns
+    -------
+    areas : dict of {name of the 2D flow area: array of perimeter coordinates}
+    """
+    areas = {}
+    with h5py.File(input_geometry_file, 'r') as f1:
+        for name, item in f1[GEOMETRY_2D_PATH].items():
+            if isinstance(item, h5py.Group) and 'Perimeter' in item:
+                areas[name] = np.array(item['Perimeter'])
+    return areas
+
+def locate_points(points, perimeters):
+    """
+    finds the 2D flow area containing each point, testing all the points against an area at once
+    
+    Parameters
+    ----------
+    points: array (n x 2) of point coordinates
+    perimeters: list of arrays of perimeter coordinates
+        
+    Returns
+    -------
+    area : array of the index of the perimeter containing each point, -1 if the point is out of all of them
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    area = np.full(len(points), -1)
+    for k, perimeter in enumerate(perimeters):
+        todo = np.flatnonzero(area < 0)
+        if len(todo) == 0:
+            break
+        inside = Path(np.asarray(perimeter, dtype=float)).contains_points(points[todo])
+        area[todo[inside]] = k
+    return area
 
 def idw_rblock(xz,yz,r,p,x,y,z):
     """
@@ -148,6 +290,225 @@ def idw_rblock(xz,yz,r,p,x,y,z):
         z_idw=np.dot(z_block,wt)/sum(w_list) # idw calculation using dot product
     return z_idw
 
+def idw_weights(xz,yz,r,p,x,y):
+    """
+    builds the IDW weights of many unsampled points at once, giving the same estimates as 
+    calling idw_rblock for each point
+    
+    Parameters
+    ----------
+    xz: x-coordinates of unsampled points
+    yz: y-coordinates of unsampled points
+    r: search radius (half width of the square search block)
+    p: power value of IDW 
+    x: x-coordinate of the sample points
+    y: y-coordinate of the sample points
+        
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix (unsampled points x sample points) of normalized weights
+    """
+    xz = np.atleast_1d(np.asarray(xz, dtype=float))
+    yz = np.atleast_1d(np.asarray(yz, dtype=float))
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(xz)
+    if n == 0 or len(x) == 0:
+        return sparse.csr_matrix((n, len(x)))
+
+    # the search block is a square, i.e. a ball of radius r in the Chebyshev (p=inf) norm;
+    # search a slightly larger block, then apply the exact block test of idw_rblock
+    tree = cKDTree(np.column_stack((x, y)))
+    tol = 1e-9*(abs(r) + max(np.abs(xz).max(), np.abs(yz).max(), np.abs(x).max(), np.abs(y).max()))
+    blocks = tree.query_ball_point(np.column_stack((xz, yz)), r+tol, p=np.inf)
+
+    # flatten the blocks into (point, cell) pairs sorted in cell order
+    counts = np.array([len(b) for b in blocks], dtype=np.int64)
+    rows = np.repeat(np.arange(n), counts)
+    cols = np.fromiter((i for b in blocks for i in b), dtype=np.int64, count=counts.sum())
+    order = np.lexsort((cols, rows))
+    rows = rows[order]
+    cols = cols[order]
+    in_block = ((x[cols]>=xz[rows]-r) & (x[cols]<=xz[rows]+r) &
+                (y[cols]>=yz[rows]-r) & (y[cols]<=yz[rows]+r))
+    rows = rows[in_block]
+    cols = cols[in_block]
+
+    #calculate weight based on distance and p value
+    d = np.sqrt((xz[rows]-x[cols])**2+(yz[rows]-y[cols])**2)
+    # if d=0, the estimate is the value of the first coinciding sample point
+    hit_rows, first_hit = np.unique(rows[d==0], return_index=True)
+    hit_cols = cols[d==0][first_hit]
+    no_hit = ~np.isin(rows, hit_rows)
+    rows = rows[no_hit]
+    cols = cols[no_hit]
+    w = 1/(d[no_hit]**p)
+    w = w/np.bincount(rows, weights=w, minlength=n)[rows]
+
+    weights = sparse.csr_matrix((np.concatenate((w, np.ones(len(hit_rows)))),
+                                 (np.concatenate((rows, hit_rows)), np.concatenate((cols, hit_cols)))),
+                                shape=(n, len(x)))
+    return weights
+
+def idw_apply(weights, z):
+    """
+    applies IDW weights built by idw_weights to the values of the sample points
+    
+    Parameters
+    ----------
+    weights: scipy.sparse matrix (unsampled points x sample points)
+    z: z-values of the sample points, either a vector (sample points) 
+       or a time series array (timesteps x sample points)
+        
+    Returns
+    -------
+    z_idw : estimated z values, a vector (unsampled points) or an array (timesteps x unsampled points)
+    """
+    z = np.asarray(z, dtype=float)
+    z_idw = np.asarray(weights.dot(z.T).T, dtype=float)
+    # points without any sample point in their search block cannot be estimated
+    z_idw[..., np.diff(weights.indptr)==0] = np.nan
+    return z_idw
+
+def idw_apply_hdf(weights, dataset, chunk_size=WSE_CHUNK_SIZE):
+    """
+    applies IDW weights to a (timesteps x sample points) HDF dataset, reading only the 
+    columns with a non-zero weight, chunk_size timesteps at a time
+    
+    Parameters
+    ----------
+    weights: scipy.sparse matrix (unsampled points x sample points)
+    dataset: h5py dataset (timesteps x sample points), e.g. 2D Water Surface
+    chunk_size: number of timesteps read at a time
+        
+    Returns
+    -------
+    z_idw : estimated z values (timesteps x unsampled points)
+    """
+    weights = sparse.csr_matrix(weights)
+    cols = np.unique(weights.indices) # cell indices needed by the interpolation
+    weights = weights[:, cols]
+    n_time = dataset.shape[0]
+    z_idw = np.empty((n_time, weights.shape[0]))
+    for t0, block in read_columns(dataset, cols, chunk_size):
+        z_idw[t0:t0+len(block)] = idw_apply(weights, block)
+    return z_idw
+
+def read_columns(dataset, cols, chunk_size=WSE_CHUNK_SIZE):
+    """
+    reads selected columns of a (timesteps x cells) HDF dataset as time-chunked hyperslabs
+    
+    Parameters
+    ----------
+    dataset: h5py dataset (timesteps x cells)
+    cols: sorted, unique column (cell) indices to read
+    chunk_size: number of timesteps read at a time
+        
+    Yields
+    ------
+    t0 : index of the first timestep of the chunk
+    block : array (chunk timesteps x len(cols))
+    """
+    cols = np.asarray(cols, dtype=np.int64)
+    n_time = dataset.shape[0]
+    chunk_size = max(1, int(chunk_size))
+    for t0 in range(0, n_time, chunk_size):
+        t1 = min(t0+chunk_size, n_time)
+        if len(cols) == 0:
+            yield t0, np.zeros((t1-t0, 0))
+        else:
+            yield t0, dataset[t0:t1, cols]
+
+def idw_weights_cached(xz,yz,r,p,x,y,perimeter,cache_dir,max_size=IDW_CACHE_SIZE):
+    """
+    returns the IDW weights of idw_weights from a cache folder, building and storing them 
+    on a cache miss. Weights are keyed by the 2D area perimeter, the sample points (cell 
+    centers), the unsampled points, r and p, so plans sharing a geometry reuse them. The 
+    least recently used entries are deleted once the folder grows beyond max_size
+    
+    Parameters
+    ----------
+    xz, yz, r, p, x, y: see idw_weights
+    perimeter: perimeter coordinates of the 2D flow area
+    cache_dir: string(cache folder)
+    max_size: maximum total size of the cache folder in bytes
+        
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix (unsampled points x sample points) of normalized weights
+    """
+    key = idw_cache_key(perimeter, np.column_stack((x, y)), np.column_stack((xz, yz)), r, p)
+    cache_file = os.path.join(cache_dir, key + ".npz")
+    try:
+        weights = sparse.load_npz(cache_file)
+        os.utime(cache_file) # mark the entry as recently used
+        return weights.tocsr()
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, zipfile.BadZipFile, KeyError):
+        # a corrupt entry (e.g. truncated .npz) is deleted and built again
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+
+    weights = idw_weights(xz, yz, r, p, x, y)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so that concurrent runs never read a partial entry
+    fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+    with os.fdopen(fd, 'wb') as tmp:
+        sparse.save_npz(tmp, weights)
+    os.replace(tmp_file, cache_file)
+    _evict_idw_cache(cache_dir, max_size)
+    return weights
+
+def idw_cache_key(perimeter, cells, points, r, p):
+    """
+    hash identifying a set of IDW weights
+    
+    Parameters
+    ----------
+    perimeter: perimeter coordinates of the 2D flow area
+    cells: coordinates of the cell centers
+    points: coordinates of the unsampled points
+    r: search radius
+    p: power value of IDW
+        
+    Returns
+    -------
+    key : string(hex digest)
+    """
+    h = hashlib.sha1()
+    for a in (perimeter, cells, points):
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    h.update(repr((float(r), float(p))).encode())
+    return h.hexdigest()
+
+def _evict_idw_cache(cache_dir, max_size):
+    """
+    deletes the least recently used entries of the cache folder until it fits in max_size bytes
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npz"):
+            try:
+                st = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    for mtime, size, name in entries[:-1]: # always keep the newest entry
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+            total -= size
+        except OSError:
+            pass
+
 # function to create shapefile
 def create_shp(coordinate, output_file_name, crs):
     """
@@ -165,7 +526,7 @@ def create_shp(coordinate, output_file_name, crs):
     """
     # write the data into shapefile 
     schema = { 'geometry': 'Point', 'properties': { 'Long': 'float', 'Lat': 'float' } }
-    with collection(output, "w", "ESRI Shapefile", schema, crs) as output:
+    with collection(output_file_name, "w", "ESRI Shapefile", schema, crs) as output:
         for i in coordinate:
             point = Point(float(i[0]), float(i[1]))
             output.write({'properties': {
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Provides the solver backends running HEC-RAS projects, and a pool of warm backend sessions
+reused between calls
+"""
+
+import os
+import re
+import abc
+import atexit
+import logging
+import threading
+import contextlib
+import subprocess
+import queue
+import multiprocessing.util
+import h5py
+import numpy as np
+import pandas as pd
+import utils
+
+# HEC-RAS version of the controller, e.g. "507" for RAS507.HECRASController
+# (set the RAS_VERSION environment variable or call set_version to change it)
+RAS_version_string = os.environ.get("RAS_VERSION", "507")
+
+# pool of the default sessions (see session)
+_POOL = None
+
+
+class Backend(abc.ABC):
+    """
+    interface of the solver backends
+
+    A backend opens a project, selects and computes its current plan. This base class reads
+    and edits the project files directly; subclasses implement compute_current_plan and may
+    override the other methods (e.g. with calls to the HEC-RAS controller).
+
+    Parameters
+    ----------
+    version : HEC-RAS version string (default RAS_version_string)
+    """
+
+    def __init__(self, version=None):
+        self.version = version or RAS_version_string
+        self.project = None
+
+    def open(self, RAS_prj_file):
+        """opens a project file (.prj)"""
+        self.project = os.path.abspath(RAS_prj_file)
+
+    def _plans(self):
+        # (title, filepath) of the plans of the project
+        base = os.path.splitext(self.project)[0]
+        plans = []
+        with open(self.project, 'r') as f:
+            plan_files = [base + '.' + line.split('=', 1)[1].strip() for line in f if line.startswith('Plan File=')]
+        for plan_file in filter(os.path.exists, plan_files):
+            with open(plan_file, 'r') as f:
+                title = next((line.split('=', 1)[1].strip() for line in f if line.startswith('Plan Title=')), '')
+            plans.append((title, plan_file))
+        return plans
+
+    def plan_names(self):
+        """returns the titles of the plans of the project"""
+        return [title for title, plan_file in self._plans()]
+
+    def set_current_plan(self, plan_name):
+        """sets the current plan of the project by its title"""
+        for title, plan_file in self._plans():
+            if title == plan_name:
+                utils.set_current_plan(self.project, plan_file)
+                return
+        raise ValueError("No plan titled " + plan_name + " in " + self.project)
+
+    def current_plan_file(self):
+        """returns the filepath of the current plan file"""
+        return utils.current_plan_file(self.project)
+
+    def current_geom_file(self):
+        """returns the filepath of the geometry file of the current plan"""
+        return next(f for f in utils.plan_input_files(self.current_plan_file())
+                    if os.path.splitext(f)[1][1:2].lower() == 'g')
+
+    @abc.abstractmethod
+    def compute_current_plan(self):
+        """computes the current plan, returns True if the run completed"""
+
+    def compute(self, RAS_prj_file):
+        """
+        opens a project file and computes its current plan, returns True if the run completed
+        """
+        try:
+            self.open(RAS_prj_file)
+            return self.compute_current_plan()
+        except Exception:
+            logging.exception("Current RAS plan of " + RAS_prj_file + " failed to execute")
+            # start from a new session at the next call
+            self.close()
+            return False
+
+    def close(self):
+        """closes the project (and the program running it)"""
+        self.project = None
+
+
+class ControllerBackend(Backend):
+    """
+    runs the projects with the HEC-RAS controller (Windows only)
+
+    The controller is launched at the first call and kept running with its project open
+    until close() is called, so that consecutive calls on a project do not launch HEC-RAS again.
+    The project is opened again when the project file changed on disk.
+
+    Parameters
+    ----------
+    version : HEC-RAS version string, e.g. "507" (default RAS_version_string)
+    """
+
+    def __init__(self, version=None):
+        super().__init__(version)
+        self.hec = None
+        self._stamp = None
+
+    def __getstate__(self):
+        # a backend sent to another process starts its own controller
+        state = dict(self.__dict__)
+        state.update(hec=None, project=None, _stamp=None)
+        return state
+
+    def _touch(self):
+        # the controller saves the project file, keep it open
+        self._stamp = os.stat(self.project).st_mtime_ns
+
+    def open(self, RAS_prj_file):
+        RAS_prj_file = os.path.abspath(RAS_prj_file)
+        if self.hec is None:
+            from win32com.client import Dispatch
+            self.hec = Dispatch("RAS" + self.version + ".HECRASController")
+            self.project = None
+        if self.project != RAS_prj_file or self._stamp != os.stat(RAS_prj_file).st_mtime_ns:
+            self.hec.Project_Open(RAS_prj_file)
+        self.project = RAS_prj_file
+        self._touch()
+
+    def plan_names(self):
+        return list(self.hec.Plan_Names()[1])
+
+    def set_current_plan(self, plan_name):
+        self.hec.Plan_SetCurrent(plan_name)
+        self._touch()
+
+    def current_plan_file(self):
+        return self.hec.CurrentPlanFile()
+
+    def current_geom_file(self):
+        return self.hec.CurrentGeomFile()
+
+    def compute_current_plan(self):
+        self.hec.Compute_CurrentPlan(None, None, True)
+        self._touch()
+        return bool(self.hec.Compute_Complete())
+
+    def close(self):
+        if self.hec is not None:
+            try:
+                self.hec.QuitRas()
+            except Exception:
+                pass
+        self.hec = None
+        self.project = None
+        self._stamp = None
+
+
+class CommandBackend(Backend):
+    """
+    computes the current plan with an executable, e.g. a command line build of the
+    HEC-RAS solver or a local stand-in writing the plan HDF file
+
+    Parameters
+    ----------
+    command : list of the program and its arguments, "{prj}" and "{plan}" are replaced by
+        the filepaths of the project file and of its current plan file
+    timeout : maximum duration of a run in seconds (optional)
+    version : HEC-RAS version string (default RAS_version_string)
+    """
+
+    def __init__(self, command, timeout=None, version=None):
+        super().__init__(version)
+        self.command = list(command)
+        self.timeout = timeout
+
+    def compute_current_plan(self):
+        plan_file = self.current_plan_file()
+        args = [a.format(prj=self.project, plan=plan_file) for a in self.command]
+        result = subprocess.run(args, cwd=os.path.dirname(self.project), stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, timeout=self.timeout)
+        if result.returncode != 0:
+            logging.error("Error in running " + plan_file + ": " + result.stdout.decode(errors='replace'))
+        return result.returncode == 0
+
+
+class FakeBackend(Backend):
+    """
+    in-process stand-in of HEC-RAS for testing: computing a 1D unsteady plan writes a plan
+    HDF file with the output times of the plan and the cross sections of its geometry
+
+    Parameters
+    ----------
+    results : function (plan_file, times, cross_sections) returning a dict of
+        {variable name: array (times x cross sections)} (default all zeros)
+    version : HEC-RAS version string (default RAS_version_string)
+    """
+
+    VARIABLES = ['Water Surface', 'Flow', 'Velocity Channel', 'Velocity Total']
+
+    def __init__(self, results=None, version=None):
+        super().__init__(version)
+        self.results = results
+        self.runs = []
+
+    def compute_current_plan(self):
+        plan_file = self.current_plan_file()
+        times = _plan_output_times(plan_file)
+        cross_sections = list(zip(*utils.read_network(self.current_geom_file()).cross_sections()))
+        if self.results is None:
+            results = {name: np.zeros((len(times), len(cross_sections))) for name in self.VARIABLES}
+        else:
+            results = self.results(plan_file, times, cross_sections)
+
+        ts_path = utils.TIME_STAMP_PATH.rsplit('/', 1)[0]
+        with h5py.File(plan_file + '.hdf', 'w') as f:
+            f[utils.TIME_STAMP_PATH] = np.array(times.strftime('%d%b%Y %H:%M:%S').str.upper(), dtype='S')
+            f[ts_path + '/Cross Sections/Cross Section Only'] = np.array([utils.format_cross_section_name(*cs) for cs in cross_sections], dtype='S')
+            for name, values in results.items():
+                f[ts_path + '/Cross Sections/' + name] = np.asarray(values, dtype=np.float32)
+        self.runs.append(plan_file)
+        return True
+
+
+def _plan_output_times(plan_file):
+    """
+    output times of a plan file, from its Simulation Date and Output Interval
+    """
+    units = {'SEC': 's', 'MIN': 'min', 'HOUR': 'h', 'DAY': 'D', 'WEEK': 'W'}
+    with open(plan_file, 'r') as f:
+        entries = dict(line.rstrip('\r\n').split('=', 1) for line in f if '=' in line)
+    dates = entries['Simulation Date'].split(',')
+    start, end = [pd.to_datetime(d + ' ' + t.replace('24:00', '00:00'), format='%d%b%Y %H:%M')
+                  + pd.Timedelta(days=1 if t.strip() == '24:00' else 0)
+                  for d, t in (dates[0:2], dates[2:4])]
+    number, unit = re.match(r'\s*(\d+)\s*([A-Z]+)', entries['Output Interval'].upper()).groups()
+    return pd.date_range(start, end, freq=pd.Timedelta(int(number), units[unit.rstrip('S') if unit != 'SEC' else unit]))
+
+
+class SessionPool:
+    """
+    keeps warm backends (e.g. HEC-RAS controllers with their project open) to reuse between calls
+
+    Parameters
+    ----------
+    factory : function creating a backend (default ControllerBackend)
+    size : maximum number of backends in use at the same time
+    """
+
+    def __init__(self, factory=None, size=1):
+        self.factory = factory or ControllerBackend
+        self._idle = queue.LifoQueue()
+        self._available = threading.Semaphore(size)
+        # backend lent to each thread, shared by the sessions nested in its session
+        self._leases = threading.local()
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        lends a backend of the pool (a new one if none is idle) for the duration of a with statement;
+        a session nested in another session of the same thread uses the same backend
+        """
+        ras = getattr(self._leases, 'backend', None)
+        if ras is not None:
+            # the outer session returns the backend to the pool
+            yield ras
+            return
+        with self._available:
+            try:
+                ras = self._idle.get_nowait()
+            except queue.Empty:
+                ras = self.factory()
+            self._leases.backend = ras
+            try:
+                yield ras
+            except BaseException:
+                # the program may be in any state, launch it again at the next use
+                ras.close()
+                raise
+            finally:
+                self._leases.backend = None
+                self._idle.put(ras)
+
+    def close(self):
+        """closes the idle backends"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def get_pool():
+    """returns the pool of the default sessions (HEC-RAS controllers)"""
+    global _POOL
+    if _POOL is None:
+        _POOL = SessionPool()
+        atexit.register(_POOL.close)
+        # worker processes of a process pool do not run atexit
+        multiprocessing.util.Finalize(None, _POOL.close, exitpriority=10)
+    return _POOL
+
+
+def set_version(version):
+    """
+    sets the HEC-RAS version of the default sessions, e.g. "631"; idle sessions of the
+    previous version are closed
+    """
+    global RAS_version_string
+    RAS_version_string = str(version)
+    if _POOL is not None:
+        _POOL.close()
+
+
+@contextlib.contextmanager
+def session(backend=None):
+    """
+    with statement giving a backend: the backend if given, else a warm session of the default pool
+    """
+    if backend is not None:
+        yield backend
+    else:
+        with get_pool().session() as ras:
+            yield ras
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Provides a scheduler computing the plans of a HEC-RAS project on parallel workers,
+each worker running in its own copy (sandbox) of the project folder
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import utils
+from backend import ControllerBackend
+
+# output files of the plans (plan HDF and binary output), not copied to the sandboxes
+PLAN_OUTPUT = re.compile(r'\.(p\d\d\.hdf|p\d\d\.tmp\.hdf|O\d\d|IC\.O\d\d|bco\d\d)$', re.IGNORECASE)
+
+# inputs which HEC-RAS and RAS Mapper only read (terrain of the Terrain folder), hardlinked to the
+# sandboxes instead of copied; the mapping outputs and other files of the subfolders are copied
+LINK_FILES = re.compile(r'(^|[\\/])Terrain[\\/].*\.(hdf|tif|tiff|vrt)$', re.IGNORECASE)
+
+# settings and sandbox of the worker process
+_WORKER = {}
+
+
+def run_scenarios(RAS_prj_file, plans, results_dir, backend=None, workers=None, sandbox_dir=None, link=True):
+    """
+    computes plans of a HEC-RAS project on parallel workers and moves the plan HDF files to a
+    results folder; the project is copied once to a sandbox folder per worker, so that the runs
+    never write to the same files
+
+    Parameters
+    ----------
+    RAS_prj_file : string (filepath of the project file)
+    plans : list of plan files or their extensions, e.g. ["model.p01", "p02"]
+    results_dir : string (folder of the results store)
+    backend : solver backend computing the current plan of a project file (default ControllerBackend);
+        each worker uses its own copy of it, kept open between its runs
+    workers : number of workers (default: one per plan, at most the number of CPUs)
+    sandbox_dir : string (folder of the sandboxes, default a temporary folder deleted at the end)
+    link : hardlink the read-only inputs of the project instead of copying them: True for
+        LINK_FILES, or a regular expression (string or compiled) of their filepaths relative to
+        the project folder
+
+    Returns
+    -------
+    runs : DataFrame (plans) with columns
+        Plan : extension of the plan file
+        Status : "Done" or "Error"
+        Results : filepath of the plan HDF file in the results store
+        Worker : sandbox folder of the run
+    """
+    plans = [os.path.splitext(p)[1][1:] if '.' in p else p for p in plans]
+    if not plans:
+        return pd.DataFrame(columns=['Plan', 'Status', 'Results', 'Worker'])
+    backend = backend or ControllerBackend()
+    workers = workers or min(len(plans), os.cpu_count() or 1)
+    os.makedirs(results_dir, exist_ok=True)
+    temporary = sandbox_dir is None
+    sandbox_dir = tempfile.mkdtemp(prefix='ras_sandbox_') if temporary else sandbox_dir
+    os.makedirs(sandbox_dir, exist_ok=True)
+
+    settings = {'prj': os.path.abspath(RAS_prj_file), 'sandbox_dir': os.path.abspath(sandbox_dir),
+                'results_dir': os.path.abspath(results_dir), 'backend': backend, 'link': link}
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(settings,)) as pool:
+            runs = list(pool.map(_run_plan, plans))
+    finally:
+        if temporary:
+            shutil.rmtree(sandbox_dir, ignore_errors=True)
+    return pd.DataFrame(runs, columns=['Plan', 'Status', 'Results', 'Worker'])
+
+
+def make_sandbox(project_dir, sandbox, link=True, exclude=()):
+    """
+    copies a project folder to a sandbox folder, without the plan outputs
+
+    Parameters
+    ----------
+    project_dir : string (folder of the project)
+    sandbox : string (folder of the copy)
+    link : hardlink the read-only inputs instead of copying them: True for LINK_FILES, or a
+        regular expression (string or compiled) of their filepaths relative to the project
+        folder (files are copied where hardlinks are not supported)
+    exclude : folders not copied, e.g. the sandboxes when they are inside the project folder
+    """
+    project_dir = os.path.abspath(project_dir)
+    if link is True:
+        link = LINK_FILES
+    elif isinstance(link, str):
+        link = re.compile(link, re.IGNORECASE)
+    exclude = {os.path.abspath(e) for e in exclude} | {os.path.abspath(sandbox)}
+    for root, dirs, files in os.walk(project_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) not in exclude]
+        rel = os.path.relpath(root, project_dir)
+        dest = os.path.normpath(os.path.join(sandbox, rel))
+        os.makedirs(dest, exist_ok=True)
+        for name in files:
+            if rel == os.curdir and PLAN_OUTPUT.search(name):
+                continue
+            src, dst = os.path.join(root, name), os.path.join(dest, name)
+            if os.path.exists(dst):
+                continue
+            # a hardlink shares the file with the project, so that only inputs never written can be linked
+            if link and link.search(os.path.relpath(src, project_dir)):
+                try:
+                    os.link(src, dst)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(src, dst)
+
+
+def _init_worker(settings):
+    _WORKER.clear()
+    _WORKER.update(settings)
+    # close the backend (e.g. quit HEC-RAS) when the worker process exits
+    multiprocessing.util.Finalize(None, settings['backend'].close, exitpriority=10)
+
+
+def _run_plan(plan):
+    """
+    computes a plan in the sandbox of the worker process and moves its plan HDF file to the results store
+    """
+    prj = _WORKER['prj']
+    if 'sandbox' not in _WORKER:
+        sandbox = tempfile.mkdtemp(prefix='worker_', dir=_WORKER['sandbox_dir'])
+        make_sandbox(os.path.dirname(prj), sandbox, _WORKER['link'],
+                     exclude=(_WORKER['sandbox_dir'], _WORKER['results_dir']))
+        _WORKER['sandbox'] = sandbox
+    sandbox = _WORKER['sandbox']
+
+    sandbox_prj = os.path.join(sandbox, os.path.basename(prj))
+    plan_file = os.path.splitext(sandbox_prj)[0] + '.' + plan
+    hdf_file = plan_file + '.hdf'
+    # never collect the results of an earlier run
+    if os.path.exists(hdf_file):
+        os.remove(hdf_file)
+
+    utils.set_current_plan(sandbox_prj, plan)
+    if not _WORKER['backend'].compute(sandbox_prj) or not os.path.exists(hdf_file):
+        return [plan, 'Error', None, sandbox]
+
+    results = os.path.join(_WORKER['results_dir'], os.path.basename(hdf_file))
+    if os.path.exists(results):
+        os.remove(results)
+    shutil.move(hdf_file, results)
+    return [plan, 'Done', results, sandbox]
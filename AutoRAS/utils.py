@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+"""
+Provides helper functions shared by the AutoRAS modules for reading HEC-RAS results
+"""
+
+import io
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import functools
+import contextlib
+from collections import OrderedDict
+from zipfile import ZipFile, BadZipFile
+import h5py
+import numpy as np
+import pandas as pd
+
+# number of timesteps read from the HDF file at a time
+CHUNK_SIZE = 1000
+
+# maximum total size (bytes) of the run cache folder
+RUN_CACHE_SIZE = 10*1024**3
+
+# separator of the members of zip archives in filepaths, e.g. outer.zip!/inner.zip!/model.g01
+ARCHIVE_SEPARATOR = '!/'
+
+# size (bytes) up to which zip files inside zip files are kept in memory instead of a temporary file
+INNER_ZIP_MEMORY = 256*1024**2
+
+# number of parsed geometry networks kept in memory
+NETWORK_CACHE_SIZE = 32
+
+# node types of the geometry files (first field of Type RM Length L Ch R)
+NODE_TYPES = {1: 'Cross Section', 2: 'Culvert', 3: 'Bridge', 4: 'Multiple Opening',
+              5: 'Inline Structure', 6: 'Lateral Structure'}
+
+# HDF path of the time stamps of unsteady results
+TIME_STAMP_PATH = '/Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/Time Date Stamp'
+
+# width of the river and reach fields in the names of the cross sections of plan HDF files
+XS_NAME_WIDTH = 16
+
+# parsed networks by the hash of their geometry file, and the hash by (filepath, mtime, size),
+# least recently used first
+_NETWORKS = OrderedDict()
+_NETWORK_KEYS = OrderedDict()
+
+# three letter month names in sorted order of their character codes, and their month index
+_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+_MONTH_CODES = np.array(sorted(ord(m[0])*65536 + ord(m[1])*256 + ord(m[2]) for m in _MONTHS))
+_MONTH_ORDER = np.array([_MONTHS.index(m) for m in sorted(_MONTHS)])
+
+
+def parse_time_stamps(time_stamps):
+    """
+    parses HEC-RAS Time Date Stamp strings (DDMMMYYYY HH:MM:SS, 24:00 is 00:00 of the next day)
+    in a single vectorized pass
+
+    Parameters
+    ----------
+    time_stamps : array of strings or bytestrings
+
+    Returns
+    -------
+    DatetimeIndex
+    """
+    stamps = np.asarray(time_stamps)
+    if stamps.dtype.kind == 'U':
+        stamps = np.char.encode(stamps, 'ascii')
+    stamps = np.char.upper(np.char.strip(stamps.astype('S')))
+    if len(stamps) == 0:
+        return pd.DatetimeIndex([])
+    if (np.char.str_len(stamps) != 18).any():
+        raise ValueError("Time Date Stamp is not in the DDMMMYYYY HH:MM:SS format")
+    stamps = stamps.astype('S18')
+
+    # view the fixed width strings as a (timesteps x 18) array of characters
+    c = np.frombuffer(stamps.tobytes(), dtype=np.uint8).reshape(-1, 18).astype(np.int64)
+    d = c - ord('0')
+    day = d[:, 0]*10 + d[:, 1]
+    year = d[:, 5]*1000 + d[:, 6]*100 + d[:, 7]*10 + d[:, 8]
+    hour, minute, second = d[:, 10]*10 + d[:, 11], d[:, 13]*10 + d[:, 14], d[:, 16]*10 + d[:, 17]
+    seconds = hour*3600 + minute*60 + second
+    month_code = c[:, 2]*65536 + c[:, 3]*256 + c[:, 4]
+    month = np.searchsorted(_MONTH_CODES, month_code)
+    digits = np.delete(d, [2, 3, 4, 9, 12, 15], axis=1)
+    if ((month >= 12) | (_MONTH_CODES[np.minimum(month, 11)] != month_code)).any() \
+            or ((digits < 0) | (digits > 9)).any() \
+            or (c[:, 9] != ord(' ')).any() or (c[:, [12, 15]] != ord(':')).any():
+        raise ValueError("Time Date Stamp is not in the DDMMMYYYY HH:MM:SS format")
+    month = _MONTH_ORDER[month]
+
+    # the day must be in the month, the time from 00:00:00 to 24:00:00
+    first = ((year - 1970)*12 + month).astype('datetime64[M]')
+    days = ((first + 1).astype('datetime64[D]') - first.astype('datetime64[D]')).astype(np.int64)
+    if ((day < 1) | (day > days) | (minute > 59) | (second > 59)
+            | (hour > 24) | ((hour == 24) & (minute*60 + second > 0))).any():
+        raise ValueError("Time Date Stamp is not a valid date and time")
+
+    # build the datetimes from the month, day and seconds (24:00 rolls over to the next day)
+    times = first.astype('datetime64[D]') + (day - 1)
+    times = times.astype('datetime64[s]') + seconds
+    return pd.DatetimeIndex(times.astype('datetime64[ns]'))
+
+
+def read_time_stamps(hdf_file, dataset=TIME_STAMP_PATH):
+    """
+    reads and parses the Time Date Stamp of a plan HDF file; the result is cached, so the
+    time index of a plan file is only built once while the file is unchanged
+
+    Parameters
+    ----------
+    hdf_file : filepath of the plan HDF file or an open h5py file
+    dataset : HDF path of the Time Date Stamp dataset
+
+    Returns
+    -------
+    DatetimeIndex
+    """
+    filename = os.path.abspath(hdf_file.filename if isinstance(hdf_file, h5py.File) else hdf_file)
+    st = os.stat(filename)
+    return _read_time_stamps(filename, st.st_mtime_ns, st.st_size, dataset)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_time_stamps(filename, mtime, size, dataset):
+    with h5py.File(filename, 'r') as f:
+        return parse_time_stamps(f[dataset][:])
+
+
+def split_cross_section_names(names):
+    """
+    splits the names of the cross sections of a plan HDF file (Cross Section Only dataset)
+    into river, reach and river station; the river and reach names are fields of
+    XS_NAME_WIDTH characters, so that they may contain spaces (e.g. "Fall River")
+
+    Parameters
+    ----------
+    names : array of the names (bytes or strings)
+
+    Returns
+    -------
+    river, reach, xs_id : arrays of strings
+    """
+    names = [n.decode() if isinstance(n, bytes) else str(n) for n in names]
+    w = XS_NAME_WIDTH
+    river = np.array([n[:w].strip() for n in names], dtype=str)
+    reach = np.array([n[w:2*w].strip() for n in names], dtype=str)
+    xs_id = np.array([n[2*w:].strip() for n in names], dtype=str)
+    return river, reach, xs_id
+
+
+def format_cross_section_name(river, reach, xs_id):
+    """name of a cross section as written in the Cross Section Only dataset of a plan HDF file"""
+    return river.ljust(XS_NAME_WIDTH) + reach.ljust(XS_NAME_WIDTH) + str(xs_id)
+
+
+def unsteady_statistics(dataset, times, thresholds=None, chunk_size=CHUNK_SIZE):
+    """
+    computes the peak statistics of a (timesteps x locations) time series in one pass,
+    reading chunk_size timesteps at a time
+
+    Parameters
+    ----------
+    dataset : h5py dataset or array (timesteps x locations), e.g. Water Surface of the
+        1D cross sections or of the cells of a 2D flow area
+    times : DatetimeIndex of the timesteps
+    thresholds : list of thresholds (optional); a threshold is either a number or
+        an array with one value per location
+    chunk_size : number of timesteps read at a time
+
+    Returns
+    -------
+    stats : DataFrame (locations) with columns
+        Max : maximum value
+        Time of Max : time of the (first) maximum
+        Min : minimum value
+        Duration above <threshold> : time (hours) above each threshold, a timestep lasting until
+            the next one (columns of per-location thresholds are named Duration above threshold <i>)
+    """
+    n_time, n_loc = dataset.shape
+    times = pd.DatetimeIndex(times)
+    thresholds = [] if thresholds is None else list(thresholds)
+    # duration (hours) of each timestep
+    dt = np.zeros(n_time)
+    dt[:-1] = np.diff(times.values.astype('datetime64[ns]').astype(np.int64))/3.6e12
+
+    peak = np.full(n_loc, -np.inf)
+    peak_idx = np.zeros(n_loc, dtype=np.int64)
+    low = np.full(n_loc, np.inf)
+    durations = np.zeros((len(thresholds), n_loc))
+
+    chunk_size = max(1, int(chunk_size))
+    for t0 in range(0, n_time, chunk_size):
+        t1 = min(t0+chunk_size, n_time)
+        block = np.asarray(dataset[t0:t1], dtype=float)
+        block_max = np.where(np.isnan(block), -np.inf, block)
+
+        # running maximum and the timestep where it is first reached
+        idx = np.argmax(block_max, axis=0)
+        block_peak = block_max[idx, np.arange(n_loc)]
+        new_peak = block_peak > peak
+        peak[new_peak] = block_peak[new_peak]
+        peak_idx[new_peak] = t0 + idx[new_peak]
+
+        low = np.fmin(low, np.min(np.where(np.isnan(block), np.inf, block), axis=0))
+
+        for k, threshold in enumerate(thresholds):
+            durations[k] += dt[t0:t1].dot(block > np.asarray(threshold, dtype=float))
+
+    no_data = np.isneginf(peak)
+    peak[no_data] = np.nan
+    low[np.isposinf(low)] = np.nan
+    peak_time = pd.Series(times[peak_idx]).where(~no_data)
+
+    stats = pd.DataFrame({'Max': peak, 'Time of Max': peak_time, 'Min': low})
+    for k, threshold in enumerate(thresholds):
+        name = str(threshold) if np.isscalar(threshold) else 'threshold ' + str(k)
+        stats['Duration above ' + name] = durations[k]
+    return stats
+
+
+def current_plan_file(RAS_prj_file):
+    """
+    returns the filepath of the current plan of a HEC-RAS project file (.prj), None if it has none
+    (the project file may be a member of zip archives, see open_member)
+    """
+    with open_text(RAS_prj_file) as f:
+        for line in f:
+            if line.startswith('Current Plan='):
+                plan = line.split('=', 1)[1].strip()
+                if plan:
+                    return os.path.splitext(RAS_prj_file)[0] + '.' + plan
+    return None
+
+
+def set_current_plan(RAS_prj_file, plan):
+    """
+    sets the current plan of a HEC-RAS project file (.prj)
+
+    Parameters
+    ----------
+    RAS_prj_file : filepath of the project file
+    plan : plan file or its extension, e.g. "model.p02" or "p02"
+    """
+    plan = os.path.splitext(plan)[1][1:] if '.' in plan else plan
+    with open(RAS_prj_file, 'r', newline='') as f:
+        lines = f.readlines()
+    newline = '\r\n' if lines and lines[0].endswith('\r\n') else '\n'
+    current = [i for i, line in enumerate(lines) if line.startswith('Current Plan=')]
+    if current:
+        lines[current[0]] = 'Current Plan=' + plan + newline
+    else:
+        lines.insert(min(1, len(lines)), 'Current Plan=' + plan + newline)
+    with open(RAS_prj_file, 'w', newline='') as f:
+        f.writelines(lines)
+
+
+def plan_input_files(plan_file):
+    """
+    returns the filepaths of the geometry and flow files (.g##, .u##/.f##/.q##) used by a plan file
+    (the plan file may be a member of zip archives, see open_member)
+    """
+    base = os.path.splitext(plan_file)[0]
+    files = []
+    with open_text(plan_file) as f:
+        for line in f:
+            if line.startswith('Geom File=') or line.startswith('Flow File='):
+                files.append(base + '.' + line.split('=', 1)[1].strip())
+    return files
+
+
+def run_cache_key(plan_file, version):
+    """
+    hash of the content of a plan file, of the geometry and flow files it uses, and of the HEC-RAS version
+
+    The title, identifier and file numbers of the plan are left out, so plans running identical
+    geometry and flow data under other numbers share the key.
+
+    Parameters
+    ----------
+    plan_file : filepath of the plan file (.p##)
+    version : HEC-RAS version string, e.g. "507"
+
+    Returns
+    -------
+    key : string (hex digest)
+    """
+    h = hashlib.sha1()
+    h.update(str(version).encode() + b'\n')
+    with open(plan_file, 'rb') as f:
+        for line in f:
+            if not line.startswith((b'Plan Title=', b'Short Identifier=', b'Geom File=', b'Flow File=')):
+                h.update(line)
+    for input_file in plan_input_files(plan_file):
+        # type of the file (g, u, f or q) and its content
+        h.update(b'\n' + os.path.splitext(input_file)[1][1].encode() + b'\n')
+        with open(input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024**2), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def run_cache_restore(cache_dir, key, files):
+    """
+    copies the files of a cached run to their destination
+
+    Parameters
+    ----------
+    cache_dir : folder of the run cache
+    key : key of the run (run_cache_key)
+    files : dict of {name of the file in the cache: destination filepath}
+
+    Returns
+    -------
+    True if the run is in the cache with all the files and they were restored, else False
+    """
+    entry = os.path.join(cache_dir, key)
+    if not all(os.path.isfile(os.path.join(entry, name)) for name in files):
+        return False
+    try:
+        for name, dest in files.items():
+            shutil.copyfile(os.path.join(entry, name), dest)
+        os.utime(entry)  # mark the entry as recently used
+    except OSError:
+        return False
+    return True
+
+
+def run_cache_store(cache_dir, key, files, max_size=RUN_CACHE_SIZE):
+    """
+    stores the files of a run in the cache, deleting the least recently used runs
+    once the cache grows beyond max_size bytes
+
+    Parameters
+    ----------
+    cache_dir : folder of the run cache
+    key : key of the run (run_cache_key)
+    files : dict of {name of the file in the cache: filepath}, files that do not exist are skipped;
+        files missing from an existing entry of the run are added to it
+    max_size : maximum total size of the cache folder in bytes
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    # copy to a temporary folder first so that an entry is never read while incomplete
+    tmp_entry = tempfile.mkdtemp(suffix='.tmp', dir=cache_dir)
+    try:
+        for name, src in files.items():
+            if os.path.exists(src):
+                shutil.copyfile(src, os.path.join(tmp_entry, name))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            if not os.path.isdir(entry):
+                raise
+            # the run is already in the cache, add the files it does not have yet
+            for name in os.listdir(tmp_entry):
+                if not os.path.exists(os.path.join(entry, name)):
+                    os.replace(os.path.join(tmp_entry, name), os.path.join(entry, name))
+    except OSError:
+        # the cache cannot be written
+        pass
+    finally:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    _evict_run_cache(cache_dir, max_size)
+
+
+def _evict_run_cache(cache_dir, max_size):
+    """
+    deletes the least recently used runs of the cache folder until it fits in max_size bytes
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.endswith('.tmp') or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(e.stat().st_size for e in os.scandir(entry) if e.is_file())
+            entries.append((os.stat(entry).st_mtime, size, entry))
+        except OSError:
+            continue
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    for mtime, size, entry in entries[:-1]:  # always keep the newest run
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+class Network:
+    """
+    river network of a HEC-RAS geometry file (.g##): rivers, reaches, nodes and junctions
+    in compact arrays, parsed from the text of the file (use read_network to share the
+    network of a file between modules)
+
+    Attributes
+    ----------
+    rivers : array of the river names, in order of appearance
+    reach_names : array of the reach names (reaches in file order)
+    reach_river : array of the river index of each reach
+    reach_nodes : array (reaches + 1) of the offsets of the nodes of each reach in the node arrays
+    node_rs : array of the river stations of the nodes (strings as in the file, upstream to
+        downstream within a reach)
+    node_type : array of the node types (see NODE_TYPES)
+    node_lengths : array (nodes x 3) of the reach lengths (LOB, channel, ROB) to the next node downstream
+    junction_names : array of the junction names
+    link_junction, link_reach : arrays of the junction and the reach of each reach end joined at a junction
+    link_upstream : array, True where the reach flows into the junction, False where it flows out of it
+    """
+
+    def __init__(self, rivers, reach_names, reach_river, reach_nodes, node_rs, node_type, node_lengths,
+                 junction_names, link_junction, link_reach, link_upstream):
+        self.rivers = np.asarray(rivers, dtype=object)
+        self.reach_names = np.asarray(reach_names, dtype=object)
+        self.reach_river = np.asarray(reach_river, dtype=np.int32)
+        self.reach_nodes = np.asarray(reach_nodes, dtype=np.int64)
+        self.node_rs = np.asarray(node_rs, dtype=object)
+        self.node_type = np.asarray(node_type, dtype=np.int8)
+        self.node_lengths = np.asarray(node_lengths, dtype=float).reshape(-1, 3)
+        self.junction_names = np.asarray(junction_names, dtype=object)
+        self.link_junction = np.asarray(link_junction, dtype=np.int32)
+        self.link_reach = np.asarray(link_reach, dtype=np.int32)
+        self.link_upstream = np.asarray(link_upstream, dtype=bool)
+        # the network is shared between callers (read_network)
+        for array in self.__dict__.values():
+            array.setflags(write=False)
+
+    @classmethod
+    def read(cls, geo_file):
+        """parses a geometry file"""
+        with open(geo_file, 'r') as f:
+            return cls.from_lines(f)
+
+    @classmethod
+    def from_lines(cls, lines):
+        """parses the lines of a geometry file"""
+        rivers, reach_names, reach_river, reach_nodes = [], [], [], []
+        node_rs, node_type, node_lengths = [], [], []
+        junction_names, links = [], []
+        for line in lines:
+            if line.startswith('River Reach='):
+                river, reach = [v.strip() for v in line.split('=', 1)[1].split(',')[:2]]
+                if river not in rivers:
+                    rivers.append(river)
+                reach_names.append(reach)
+                reach_river.append(rivers.index(river))
+                reach_nodes.append(len(node_rs))
+            elif line.startswith('Type RM Length L Ch R') and reach_names:
+                fields = [v.strip() for v in line.split('=', 1)[1].split(',')]
+                fields += [''] * (5 - len(fields))
+                node_type.append(int(fields[0]))
+                node_rs.append(fields[1])
+                node_lengths.append([float(v) if v else np.nan for v in fields[2:5]])
+            elif line.startswith('Junct Name='):
+                junction_names.append(line.split('=', 1)[1].strip())
+            elif line.startswith(('Up River,Reach=', 'Dn River,Reach=')) and junction_names:
+                river, reach = [v.strip() for v in line.split('=', 1)[1].split(',')[:2]]
+                links.append((len(junction_names) - 1, river, reach, line.startswith('Up')))
+        reach_nodes.append(len(node_rs))
+
+        # reaches of the junctions, by river and reach name
+        index = {(rivers[r], name): i for i, (r, name) in enumerate(zip(reach_river, reach_names))}
+        links = [(j, index[(river, reach)], up) for j, river, reach, up in links if (river, reach) in index]
+        link_junction, link_reach, link_upstream = zip(*links) if links else ((), (), ())
+        return cls(rivers, reach_names, reach_river, reach_nodes, node_rs, node_type, node_lengths,
+                   junction_names, link_junction, link_reach, link_upstream)
+
+    def __len__(self):
+        return len(self.reach_names)
+
+    def reach(self, river, reach):
+        """index of a reach by its river and reach name"""
+        matches = np.flatnonzero((self.rivers[self.reach_river] == river) & (self.reach_names == reach))
+        if len(matches) == 0:
+            raise KeyError((river, reach))
+        return int(matches[0])
+
+    def nodes(self, reach):
+        """slice of the nodes of a reach (index) in the node arrays"""
+        return slice(self.reach_nodes[reach], self.reach_nodes[reach + 1])
+
+    def river_stations(self, reach, node_type=None):
+        """river stations of the nodes of a reach, upstream to downstream (only of a node type if given)"""
+        nodes = self.nodes(reach)
+        rs = self.node_rs[nodes]
+        return list(rs if node_type is None else rs[self.node_type[nodes] == node_type])
+
+    def cross_sections(self):
+        """
+        river, reach and river station of the cross sections, in file order
+
+        Returns
+        -------
+        river, reach, rs : arrays (cross sections)
+        """
+        node_reach = np.repeat(np.arange(len(self)), np.diff(self.reach_nodes))
+        xs = self.node_type == 1
+        return (self.rivers[self.reach_river[node_reach[xs]]], self.reach_names[node_reach[xs]],
+                self.node_rs[xs])
+
+    def upstream_reaches(self, reach):
+        """reaches flowing into the upstream end of a reach"""
+        return self._joined(reach, upstream=False)
+
+    def downstream_reaches(self, reach):
+        """reaches flowing out of the downstream end of a reach"""
+        return self._joined(reach, upstream=True)
+
+    def _joined(self, reach, upstream):
+        # junctions where the reach ends (upstream=True) or starts, and the other reaches on their other side
+        junctions = self.link_junction[(self.link_reach == reach) & (self.link_upstream == upstream)]
+        other = np.isin(self.link_junction, junctions) & (self.link_upstream != upstream)
+        return [int(r) for r in self.link_reach[other]]
+
+
+def read_network(geo_file, max_size=NETWORK_CACHE_SIZE):
+    """
+    returns the (shared, read-only) Network of a geometry file; the network is parsed once
+    per content of the file, copies of the same geometry share it
+
+    Parameters
+    ----------
+    geo_file : filepath of the geometry file (.g##)
+    max_size : number of networks (and of hashes of geometry files) kept in memory
+
+    Returns
+    -------
+    Network
+    """
+    geo_file = os.path.abspath(geo_file)
+    st = os.stat(geo_file)
+    stamp = (geo_file, st.st_mtime_ns, st.st_size)
+    digest = _NETWORK_KEYS.get(stamp)
+    if digest is None:
+        with open(geo_file, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        _NETWORK_KEYS[stamp] = digest
+        while len(_NETWORK_KEYS) > max_size:
+            _NETWORK_KEYS.popitem(last=False)
+    else:
+        _NETWORK_KEYS.move_to_end(stamp)
+    if digest in _NETWORKS:
+        _NETWORKS.move_to_end(digest)
+    else:
+        _NETWORKS[digest] = Network.read(geo_file)
+        while len(_NETWORKS) > max_size:
+            evicted, _ = _NETWORKS.popitem(last=False)
+            # the hashes of the evicted network are not needed anymore
+            for key in [k for k, v in _NETWORK_KEYS.items() if v == evicted]:
+                del _NETWORK_KEYS[key]
+    return _NETWORKS[digest]
+
+
+def is_archive_path(path):
+    """True if the filepath is a member of a zip archive, e.g. outer.zip!/inner.zip!/model.g01"""
+    return ARCHIVE_SEPARATOR in str(path)
+
+
+def path_stat(path):
+    """
+    os.stat of a file, or of the zip archive on disk holding a member of (nested) zip archives
+    """
+    return os.stat(str(path).split(ARCHIVE_SEPARATOR, 1)[0])
+
+
+def _spool(zip_ref, member):
+    # copy of a zip member to a seekable file, in memory if small
+    spool = tempfile.SpooledTemporaryFile(max_size=INNER_ZIP_MEMORY)
+    with zip_ref.open(member) as f:
+        shutil.copyfileobj(f, spool)
+    spool.seek(0)
+    return spool
+
+
+@contextlib.contextmanager
+def open_member(path):
+    """
+    opens a file, or a member of (nested) zip archives, for reading in binary mode; the member
+    is streamed from its archive without being extracted
+
+    Parameters
+    ----------
+    path : filepath, e.g. model.g01 or outer.zip!/inner.zip!/model.g01
+    """
+    parts = str(path).split(ARCHIVE_SEPARATOR)
+    if len(parts) == 1:
+        with open(path, 'rb') as f:
+            yield f
+        return
+    with contextlib.ExitStack() as stack:
+        zip_ref = stack.enter_context(ZipFile(parts[0], 'r'))
+        for inner in parts[1:-1]:
+            # an inner zip file needs a seekable copy
+            spool = stack.enter_context(_spool(zip_ref, inner))
+            zip_ref = stack.enter_context(ZipFile(spool, 'r'))
+        yield stack.enter_context(zip_ref.open(parts[-1]))
+
+
+@contextlib.contextmanager
+def open_text(path):
+    """
+    opens a file, or a member of (nested) zip archives, for reading as text (see open_member)
+    """
+    with open_member(path) as f:
+        yield io.TextIOWrapper(f, errors='replace')
+
+
+@contextlib.contextmanager
+def local_file(path):
+    """
+    gives a filepath on disk for parsers that only read filepaths: the file itself, or a temporary
+    copy of a member of zip archives, deleted at the end of the with statement
+    """
+    if not is_archive_path(path):
+        yield path
+        return
+    fd, tmp_file = tempfile.mkstemp(suffix=os.path.splitext(str(path))[1])
+    try:
+        with os.fdopen(fd, 'wb') as f, open_member(path) as member:
+            shutil.copyfileobj(member, f)
+        yield tmp_file
+    finally:
+        os.remove(tmp_file)
+
+
+def walk_archive(archive, prefix=None):
+    """
+    lists the files of a zip archive, including the files of the zip archives inside it
+
+    Parameters
+    ----------
+    archive : filepath of the zip file (or a file object of it)
+    prefix : archive path of the zip file (default its filepath)
+
+    Returns
+    -------
+    generator of (archive path, open ZipFile, ZipInfo) of the files, e.g.
+        ("outer.zip!/inner.zip!/model.g01", ...); the ZipFile is open until the next file.
+        Zip files inside it which cannot be read are logged and skipped.
+    """
+    prefix = str(archive) if prefix is None else prefix
+    with ZipFile(archive, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            path = prefix + ARCHIVE_SEPARATOR + info.filename
+            if info.filename.lower().endswith('.zip'):
+                try:
+                    with _spool(zip_ref, info) as spool:
+                        yield from walk_archive(spool, path)
+                except (BadZipFile, OSError):
+                    # the other files of the archive are still listed
+                    logging.error("Cannot read archive: " + path)
+            else:
+                yield path, zip_ref, info